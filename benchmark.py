@@ -0,0 +1,276 @@
+"""Воспроизводимый бенчмарк наложения водяных знаков.
+
+Генерирует синтетический набор изображений, прогоняет его через доступные
+движки в центрированном режиме и тайлинге, сохраняет результаты в JSON и
+сравнивает их с предыдущим запуском.
+
+    python benchmark.py --output results.json
+    python benchmark.py --output new.json --compare results.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import script
+
+# Набор изображений: (имя, ширина, высота, формат, альфа-канал, количество)
+CORPUS = {
+    'quick': [
+        ('thumb', 320, 240, 'JPEG', False, 32),
+        ('thumb_alpha', 320, 240, 'PNG', True, 16),
+        ('hd', 1920, 1080, 'JPEG', False, 16),
+        ('hd_png', 1920, 1080, 'PNG', False, 8),
+        ('12mp', 4000, 3000, 'JPEG', False, 8),
+        ('12mp_alpha', 4000, 3000, 'PNG', True, 4),
+    ],
+    'full': [
+        ('thumb', 320, 240, 'JPEG', False, 64),
+        ('thumb_alpha', 320, 240, 'PNG', True, 32),
+        ('hd', 1920, 1080, 'JPEG', False, 32),
+        ('hd_png', 1920, 1080, 'PNG', False, 16),
+        ('12mp', 4000, 3000, 'JPEG', False, 16),
+        ('12mp_alpha', 4000, 3000, 'PNG', True, 8),
+        ('24mp', 6000, 4000, 'JPEG', False, 8),
+        ('50mp', 8660, 5774, 'JPEG', False, 4),
+        ('100mp', 12240, 8160, 'JPEG', False, 2),
+        ('100mp_alpha', 12240, 8160, 'PNG', True, 1),
+    ],
+}
+SEED = 20240101
+DEFAULT_DENSITIES = '2,4,6,8,10'
+REGRESSION_THRESHOLD = 0.10
+
+def generate_corpus(corpus_dir, profile):
+    """Создает набор изображений; уже созданные файлы не пересоздаются"""
+    os.makedirs(corpus_dir, exist_ok=True)
+    rng = random.Random(SEED)
+    paths = []
+    for name, width, height, fmt, alpha, count in CORPUS[profile]:
+        ext = '.jpg' if fmt == 'JPEG' else '.png'
+        for index in range(count):
+            # Генератор продвигается всегда, чтобы содержимое не зависело от уже созданных файлов
+            noise = bytes(rng.getrandbits(8) for _ in range(32 * 32 * 4))
+            path = os.path.join(corpus_dir, f'{name}_{index:03d}{ext}')
+            paths.append(path)
+            if os.path.exists(path):
+                continue
+
+            mode = 'RGBA' if alpha else 'RGB'
+            # Шум низкого разрешения, растянутый до нужного размера, похож на фотографию
+            image = Image.frombytes('RGBA', (32, 32), noise).convert(mode)
+            image = image.resize((width, height), Image.BICUBIC)
+            if fmt == 'JPEG':
+                image.save(path, 'JPEG', quality=90)
+            else:
+                image.save(path, 'PNG', compress_level=1)
+    return paths
+
+def percentile(values, fraction):
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def peak_process_rss_mb():
+    """Наибольший пик памяти одного процесса: главного или любого из рабочих.
+
+    Это не сумма по процессам: пул из нескольких рабочих занимает больше, чем показывает замер.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # На macOS ru_maxrss в байтах, на Linux в килобайтах
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return max(own, children) / scale
+
+def run_case(case):
+    """Выполняет один замер в текущем процессе"""
+    paths = case['paths']
+    config = {
+        'opacity': 0.3,
+        'tile_enabled': case['mode'] == 'tiled',
+        'density': case['density'] or 2,
+    }
+    font_path, font_index = script.FontManager.get_font(script.FontManager.DEFAULT_FONT)
+    creator = script.WatermarkCreator('@benchmark', font_path, 100, '#FFFFFF', 45,
+                                      font_index=font_index)
+    watermark_path = creator.create()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        jobs = [
+            (path, path, os.path.join(output_dir, f'watermarked_{os.path.basename(path)}'))
+            for path in paths
+        ]
+        if case['engine'] == 'pillow-pipeline':
+            executor = script.StagePipeline(stage_workers={
+                'decode': case['workers'], 'composite': case['workers'], 'write': case['workers']
+            })
+        else:
+            executor = script.BatchExecutor(case['engine'], workers=case['workers'])
+
+        # Задержка одного изображения: от момента, когда исполнитель забирает задачу, до готовности
+        # результата. Исполнитель забирает задачи с запасом, поэтому в задержку входит и ожидание
+        # свободного рабочего внутри исполнителя, а не только сама обработка
+        submitted = {}
+
+        def timed(jobs):
+            for job in jobs:
+                submitted[job[0]] = time.perf_counter()
+                yield job
+
+        latencies = []
+        failures = 0
+        start = time.perf_counter()
+        for name, success in executor.run(timed(jobs), watermark_path, config):
+            latencies.append(time.perf_counter() - submitted.pop(name))
+            failures += not success
+        elapsed = time.perf_counter() - start
+        executor.close()
+
+    creator.cleanup()
+    script.LAYER_CACHE.clear()
+    script.SCALED_CACHE.clear()
+
+    return {
+        'engine': case['engine'],
+        'workers': case['workers'],
+        'mode': case['mode'],
+        'density': case['density'],
+        'images': len(paths),
+        'failures': failures,
+        'seconds': round(elapsed, 4),
+        'images_per_s': round(len(paths) / elapsed, 3) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'peak_process_rss_mb': round(peak_process_rss_mb(), 1),
+    }
+
+def run_isolated(case):
+    """Выполняет замер в отдельном процессе, чтобы пиковая память не смешивалась между замерами"""
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if process.returncode != 0:
+        raise Exception(f"Замер завершился с ошибкой: {process.stderr.decode()}")
+    return json.loads(process.stdout.decode().strip().splitlines()[-1])
+
+def available_engines():
+    """Движки, которые можно замерить на этой машине"""
+    engines = ['pillow', 'pillow-pipeline']
+    if script.FFmpegHandler.check_ffmpeg():
+        engines.insert(0, 'ffmpeg')
+    return engines
+
+def build_cases(paths, engines, workers, densities):
+    """Все сочетания движка, числа потоков, режима и плотности"""
+    cases = []
+    for engine in engines:
+        for worker_count in workers:
+            cases.append({'engine': engine, 'workers': worker_count, 'mode': 'centered',
+                          'density': None, 'paths': paths})
+            for density in densities:
+                cases.append({'engine': engine, 'workers': worker_count, 'mode': 'tiled',
+                              'density': density, 'paths': paths})
+    return cases
+
+def case_key(result):
+    return (result['engine'], result['workers'], result['mode'], result['density'])
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Сравнивает с предыдущими результатами, возвращает список регрессий"""
+    previous = {case_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        throughput = result['images_per_s'] / old['images_per_s'] - 1 if old['images_per_s'] else 0.0
+        latency = result['p99_ms'] / old['p99_ms'] - 1 if old['p99_ms'] else 0.0
+        line = (f"{result['engine']:16} w={result['workers']:<3} {result['mode']:8} "
+                f"d={result['density'] or '-':<3} "
+                f"{old['images_per_s']:9.2f} -> {result['images_per_s']:9.2f} img/s ({throughput:+.1%}), "
+                f"p99 {old['p99_ms']:.1f} -> {result['p99_ms']:.1f} ms ({latency:+.1%})")
+        print(line)
+        if throughput < -threshold or latency > threshold:
+            regressions.append(line)
+    return regressions
+
+def parse_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк наложения водяных знаков")
+    parser.add_argument('--profile', choices=sorted(CORPUS), default='quick',
+                        help="набор изображений (full включает снимки до 100 Мп)")
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(),
+                                                             'fastwatermarks-bench'))
+    parser.add_argument('--engines', help="движки через запятую (по умолчанию все доступные)")
+    parser.add_argument('--workers', default=f'1,{os.cpu_count() or 1}',
+                        help="количество потоков через запятую")
+    parser.add_argument('--densities', default=DEFAULT_DENSITIES,
+                        help="плотности тайлинга через запятую (2-10)")
+    parser.add_argument('--output', help="файл для сохранения результатов в JSON")
+    parser.add_argument('--compare', help="предыдущие результаты для поиска регрессий")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="допустимое ухудшение (доля, по умолчанию 0.10)")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return 0
+
+    paths = generate_corpus(os.path.join(args.corpus_dir, args.profile), args.profile)
+    engines = args.engines.split(',') if args.engines else available_engines()
+    workers = sorted(set(parse_list(args.workers)))
+    densities = parse_list(args.densities)
+
+    results = []
+    for case in build_cases(paths, engines, workers, densities):
+        result = run_isolated(case)
+        results.append(result)
+        print(f"{result['engine']:16} w={result['workers']:<3} {result['mode']:8} "
+              f"d={result['density'] or '-':<3} {result['images_per_s']:9.2f} img/s  "
+              f"p50 {result['p50_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  "
+              f"RSS/процесс {result['peak_process_rss_mb']:8.1f} MB  ошибок {result['failures']}")
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'pillow': Image.__version__,
+            'cpu_count': os.cpu_count(),
+            'profile': args.profile,
+            'seed': SEED,
+            'images': len(paths),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Найдено регрессий: {len(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,3 @@
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
 import os
 import subprocess
 from PIL import Image, ImageDraw, ImageFont
@@ -7,12 +5,477 @@ import tempfile
 import sys
 from pathlib import Path
 import glob
+import json
+import io
+import hashlib
+import math
+from functools import lru_cache
+from collections import OrderedDict
+import threading
+import queue
+import time
+import signal
+import select
+import struct
+import ctypes
+import ctypes.util
+import argparse
+import multiprocessing
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                wait, FIRST_COMPLETED)
 
 # Добавляем ffmpeg в PATH
 os.environ['PATH'] = '/opt/homebrew/bin:' + os.environ.get('PATH', '')
 
+# Tk загружается только для интерфейса: пакетный режим и рабочие процессы без него
+tk = ttk = filedialog = messagebox = ImageTk = None
+
+def _import_tk():
+    """Импортирует tkinter и ImageTk для графического интерфейса"""
+    global tk, ttk, filedialog, messagebox, ImageTk
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox
+    from PIL import ImageTk
+
+def _cache_dir():
+    """Папка для постоянных кэшей приложения"""
+    if sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = os.path.join(base, 'FastWatermarks')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _write_json_atomic(path, data):
+    """Записывает JSON через временный файл, чтобы не оставить его недописанным"""
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+class _NullStage:
+    """Заглушка замера, когда метрики выключены"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, bytes_read=0, bytes_written=0):
+        pass
+
+    success = property(lambda self: None, lambda self, value: None)
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    """Замер длительности одной стадии"""
+    __slots__ = ('metrics', 'name', 'start', 'bytes_read', 'bytes_written')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics._finish_stage(self, time.perf_counter() - self.start)
+        return False
+
+    def add(self, bytes_read=0, bytes_written=0):
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+class _ImageRecord:
+    """Сбор стадий одного изображения (или группы) в одну строку журнала"""
+    __slots__ = ('metrics', 'images', 'stages', 'bytes_read', 'bytes_written', 'success',
+                 'start', '_previous')
+
+    def __init__(self, metrics, images):
+        self.metrics = metrics
+        self.images = images
+        self.stages = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.success = None
+
+    def __enter__(self):
+        self._previous = getattr(self.metrics._local, 'record', None)
+        self.metrics._local.record = self
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics._local.record = self._previous
+        self.metrics.record_image(self.images, self.stages, self.bytes_read, self.bytes_written,
+                                  bool(self.success) and exc[0] is None,
+                                  time.perf_counter() - self.start)
+        return False
+
+    def add(self, bytes_read=0, bytes_written=0):
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+class Metrics:
+    """Замеры стадий обработки: журнал JSON по изображениям, итоговая сводка и экспорт Prometheus.
+
+    Выключенные метрики возвращают общую заглушку, поэтому замеры в коде почти ничего не стоят.
+    Рабочие процессы дописывают строки в общий журнал, а сводка строится по нему в конце.
+    """
+    # Границы корзин гистограммы, секунды
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.enabled = False
+        self.log_path = None
+        self.prometheus_path = None
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, log_path, prometheus_path=None, truncate=True):
+        """Включает метрики с журналом в log_path (None выключает)"""
+        self.close()
+        self.enabled = bool(log_path)
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        if self.enabled and truncate:
+            open(log_path, 'w').close()
+
+    def ensure(self, config):
+        """Включает метрики в рабочем процессе по настройкам задачи"""
+        log_path = config.get('metrics_log')
+        if log_path != self.log_path:
+            self.configure(log_path, truncate=False)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+
+    def stage(self, name):
+        """Контекст замера стадии; внутри image() время относится к изображению"""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def image(self, *images):
+        """Контекст обработки изображения (или группы изображений одним вызовом)"""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _ImageRecord(self, list(images))
+
+    def _finish_stage(self, stage, seconds):
+        record = getattr(self._local, 'record', None)
+        if record is not None:
+            record.stages[stage.name] = record.stages.get(stage.name, 0.0) + seconds
+            record.add(stage.bytes_read, stage.bytes_written)
+        else:
+            self._write({'stage': stage.name, 'seconds': seconds,
+                         'bytes_read': stage.bytes_read, 'bytes_written': stage.bytes_written})
+
+    def record_image(self, images, stages, bytes_read, bytes_written, success, seconds):
+        """Записывает строку журнала для изображения"""
+        if not self.enabled:
+            return
+        self._write({'images': images, 'stages': stages, 'bytes_read': bytes_read,
+                     'bytes_written': bytes_written, 'success': success, 'seconds': seconds})
+
+    def record_caches(self, caches):
+        """Записывает счетчики кэшей водяного знака текущего процесса"""
+        if not self.enabled:
+            return
+        self._write({'pid': os.getpid(), 'caches': caches})
+
+    def _write(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            # После fork у рабочего процесса должен быть свой дескриптор
+            if self._file is None or self._pid != os.getpid():
+                self._file = open(self.log_path, 'a', encoding='utf-8')
+                self._pid = os.getpid()
+            self._file.write(line)
+            self._file.flush()
+
+    def summary(self):
+        """Строит сводку по журналу: гистограммы стадий, байты, количество изображений"""
+        if not self.enabled:
+            return None
+        self.close()
+        stages = {}
+        totals = {'images': 0, 'failed': 0, 'bytes_read': 0, 'bytes_written': 0}
+        # Процесс -> кэш -> счетчики; счетчики растут, поэтому берем наибольшие
+        processes = {}
+
+        def observe(name, seconds):
+            stage = stages.setdefault(name, {'count': 0, 'sum': 0.0, 'values': []})
+            stage['count'] += 1
+            stage['sum'] += seconds
+            stage['values'].append(seconds)
+
+        with open(self.log_path, encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if 'caches' in entry:
+                    counters = processes.setdefault(entry['pid'], {})
+                    for name, stats in entry['caches'].items():
+                        current = counters.setdefault(name, {'hits': 0, 'misses': 0, 'evictions': 0})
+                        for field in current:
+                            current[field] = max(current[field], stats.get(field, 0))
+                    continue
+                totals['bytes_read'] += entry['bytes_read']
+                totals['bytes_written'] += entry['bytes_written']
+                if 'images' in entry:
+                    totals['images'] += len(entry['images'])
+                    totals['failed'] += 0 if entry['success'] else len(entry['images'])
+                    observe('image', entry['seconds'])
+                    for name, seconds in entry['stages'].items():
+                        observe(name, seconds)
+                else:
+                    observe(entry['stage'], entry['seconds'])
+
+        for stage in stages.values():
+            values = sorted(stage.pop('values'))
+            stage['p50'] = values[len(values) // 2]
+            stage['p99'] = values[min(len(values) - 1, int(len(values) * 0.99))]
+            stage['buckets'] = [sum(1 for v in values if v <= bound) for bound in self.BUCKETS]
+
+        caches = {}
+        for counters in processes.values():
+            for name, stats in counters.items():
+                cache = caches.setdefault(name, {'hits': 0, 'misses': 0, 'evictions': 0})
+                for field, value in stats.items():
+                    cache[field] += value
+        for cache in caches.values():
+            total = cache['hits'] + cache['misses']
+            cache['hit_rate'] = cache['hits'] / total if total else 0.0
+        return {'totals': totals, 'stages': stages, 'buckets': list(self.BUCKETS), 'caches': caches}
+
+    def write_summary(self):
+        """Сохраняет сводку рядом с журналом и, если задано, в textfile для Prometheus"""
+        summary = self.summary()
+        if summary is None:
+            return None
+        _write_json_atomic(self.log_path + '.summary.json', summary)
+        if self.prometheus_path:
+            self._write_prometheus(summary)
+        return summary
+
+    def _write_prometheus(self, summary):
+        lines = [
+            '# HELP fastwatermarks_stage_seconds Duration of processing stages',
+            '# TYPE fastwatermarks_stage_seconds histogram',
+        ]
+        for name, stage in sorted(summary['stages'].items()):
+            for bound, count in zip(summary['buckets'], stage['buckets']):
+                lines.append(f'fastwatermarks_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+            lines.append(f'fastwatermarks_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {stage["count"]}')
+            lines.append(f'fastwatermarks_stage_seconds_sum{{stage="{name}"}} {stage["sum"]}')
+            lines.append(f'fastwatermarks_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+
+        totals = summary['totals']
+        lines += [
+            '# TYPE fastwatermarks_images_total counter',
+            f'fastwatermarks_images_total{{result="ok"}} {totals["images"] - totals["failed"]}',
+            f'fastwatermarks_images_total{{result="failed"}} {totals["failed"]}',
+            '# TYPE fastwatermarks_bytes_read_total counter',
+            f'fastwatermarks_bytes_read_total {totals["bytes_read"]}',
+            '# TYPE fastwatermarks_bytes_written_total counter',
+            f'fastwatermarks_bytes_written_total {totals["bytes_written"]}',
+            '# TYPE fastwatermarks_cache_requests_total counter',
+        ]
+        for name, cache in sorted(summary['caches'].items()):
+            lines.append(f'fastwatermarks_cache_requests_total{{cache="{name}",result="hit"}} {cache["hits"]}')
+            lines.append(f'fastwatermarks_cache_requests_total{{cache="{name}",result="miss"}} {cache["misses"]}')
+        lines.append('# TYPE fastwatermarks_cache_evictions_total counter')
+        for name, cache in sorted(summary['caches'].items()):
+            lines.append(f'fastwatermarks_cache_evictions_total{{cache="{name}"}} {cache["evictions"]}')
+
+        # textfile collector требует атомарной замены файла
+        directory = os.path.dirname(self.prometheus_path) or '.'
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.prom')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.prometheus_path)
+
+# Общие метрики для текущего процесса (по умолчанию выключены)
+METRICS = Metrics()
+
+class MetadataIndex:
+    """Постоянный индекс размеров, формата и ориентации изображений.
+
+    Хранится отдельным файлом на каждый каталог с изображениями, поэтому сохранение
+    переписывает только каталоги, где что-то изменилось.
+    """
+    VERSION = 2
+    EXIF_ORIENTATION = 0x0112
+    # Как часто сохранять индекс во время длинного пакета, секунды
+    SAVE_INTERVAL = 30.0
+
+    def __init__(self, index_dir=None):
+        self.index_dir = index_dir
+        # Каталог -> {имя файла: запись}
+        self._dirs = {}
+        self._dirty = set()
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _shard_path(self, directory):
+        if self.index_dir is None:
+            self.index_dir = os.path.join(_cache_dir(), 'metadata_index')
+        digest = hashlib.blake2b(os.fsencode(directory), digest_size=16).hexdigest()
+        return os.path.join(self.index_dir, f'{digest}.json')
+
+    @staticmethod
+    def _read_shard(path, directory):
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == MetadataIndex.VERSION and data.get('dir') == directory:
+                return data['entries']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ошибка чтения индекса метаданных: {e}")
+        return {}
+
+    def _entries(self, directory):
+        entries = self._dirs.get(directory)
+        if entries is None:
+            entries = self._read_shard(self._shard_path(directory), directory)
+            # При первом обращении к каталогу убираем записи об удаленных файлах
+            existing = self._listdir(directory)
+            pruned = {name: entry for name, entry in entries.items() if name in existing}
+            if len(pruned) != len(entries):
+                self._dirty.add(directory)
+            entries = self._dirs[directory] = pruned
+        return entries
+
+    @staticmethod
+    def _listdir(directory):
+        try:
+            return set(os.listdir(directory))
+        except OSError:
+            return set()
+
+    def probe(self, image_path):
+        """Возвращает {'width', 'height', 'format', 'orientation'} или None"""
+        path = os.path.abspath(image_path)
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            print(f"Ошибка получения размеров: {e}")
+            return None
+
+        directory, name = os.path.split(path)
+        with self._lock:
+            entry = self._entries(directory).get(name)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                return entry
+
+        entry = self.read_header(path)
+        if entry is None:
+            return None
+        entry.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+
+        with self._lock:
+            self._entries(directory)[name] = entry
+            self._dirty.add(directory)
+        return entry
+
+    @staticmethod
+    def read_header(image_path):
+        """Читает метаданные из заголовка файла без декодирования пикселей"""
+        try:
+            with Image.open(image_path) as img:
+                width, height = img.size
+                orientation = 1
+                if img.format in ('JPEG', 'TIFF', 'WEBP'):
+                    orientation = img.getexif().get(MetadataIndex.EXIF_ORIENTATION, 1)
+                return {
+                    'width': width,
+                    'height': height,
+                    'format': img.format,
+                    'orientation': orientation,
+                }
+        except Exception as e:
+            print(f"Ошибка чтения заголовка {image_path}: {e}")
+            return None
+
+    def dimensions(self, image_path):
+        """Размеры изображения (ширина, высота)"""
+        entry = self.probe(image_path)
+        if entry is None:
+            return None, None
+        return entry['width'], entry['height']
+
+    def group_by_resolution(self, image_paths):
+        """Группирует пути по разрешению; нечитаемые файлы попадают в группу None"""
+        groups = OrderedDict()
+        for path in image_paths:
+            entry = self.probe(path)
+            key = (entry['width'], entry['height']) if entry else None
+            groups.setdefault(key, []).append(path)
+        return groups
+
+    def save(self):
+        """Сохраняет изменившиеся каталоги; записи об удаленных файлах выбрасываются"""
+        with self._lock:
+            dirty = {directory: dict(self._dirs[directory]) for directory in self._dirty}
+            self._dirty = set()
+            self._last_save = time.monotonic()
+
+        for directory, entries in dirty.items():
+            path = self._shard_path(directory)
+            # Другие процессы (например, шарды пакета) могли дописать этот же каталог
+            merged = self._read_shard(path, directory)
+            merged.update(entries)
+            existing = self._listdir(directory)
+            merged = {name: entry for name, entry in merged.items() if name in existing}
+            try:
+                if merged:
+                    os.makedirs(self.index_dir, exist_ok=True)
+                    _write_json_atomic(path, {'version': self.VERSION, 'dir': directory,
+                                              'entries': merged})
+                elif os.path.exists(path):
+                    os.unlink(path)
+            except Exception as e:
+                print(f"Ошибка сохранения индекса метаданных: {e}")
+                with self._lock:
+                    self._dirty.add(directory)
+
+    def save_if_due(self):
+        """Сохраняет индекс не чаще SAVE_INTERVAL"""
+        if time.monotonic() - self._last_save >= self.SAVE_INTERVAL:
+            self.save()
+
+# Общий индекс метаданных для текущего процесса
+METADATA_INDEX = MetadataIndex()
+
 class FFmpegHandler:
     """Класс для работы с FFmpeg"""
+    CENTER_POSITION = '(main_w-overlay_w)/2:(main_h-overlay_h)/2'
+    # Водяной знак передается через дополнительный канал (pass_fds есть только в POSIX)
+    PIPE_INPUTS = os.name == 'posix'
+    # Кодеки для результата, читаемого из stdout
+    OUTPUT_CODECS = {'png': 'png', 'jpg': 'mjpeg', 'jpeg': 'mjpeg', 'webp': 'libwebp',
+                     'bmp': 'bmp', 'tif': 'tiff', 'tiff': 'tiff'}
+
     @staticmethod
     def check_ffmpeg():
         """Проверяет наличие ffmpeg в системе"""
@@ -26,6 +489,17 @@ class FFmpegHandler:
     @staticmethod
     def get_dimensions(image_path):
         """Получает размеры изображения"""
+        # Сначала заголовок файла и индекс, ffprobe только для неизвестных Pillow форматов
+        with METRICS.stage('probe'):
+            width, height = METADATA_INDEX.dimensions(image_path)
+        if width and height:
+            return width, height
+        with METRICS.stage('ffprobe'):
+            return FFmpegHandler.probe_dimensions(image_path)
+
+    @staticmethod
+    def probe_dimensions(image_path):
+        """Получает размеры через ffprobe"""
         ffprobe_path = '/opt/homebrew/bin/ffprobe' if sys.platform == 'darwin' else 'ffprobe'
         try:
             cmd = [
@@ -53,28 +527,495 @@ class FFmpegHandler:
                 raise Exception("Не удалось получить размеры изображения")
 
             # Определяем масштаб и создаем фильтр
-            scale = min(width, height) * (0.15 if config['tile_enabled'] else 0.3)
-            filter_complex = FFmpegHandler._create_filter_complex(
-                scale, config['opacity'], config['tile_enabled'], config['density']
+            mark, filter_complex = FFmpegHandler.overlay_filter(
+                watermark_path, (width, height), config, in_memory=FFmpegHandler.PIPE_INPUTS
             )
 
             # Формируем команду
-            command = [
-                ffmpeg_path,
-                '-i', input_path,
-                '-i', watermark_path,
+            def command(pipes):
+                return [
+                    ffmpeg_path,
+                    '-i', input_path,
+                    *FFmpegHandler._mark_input(mark, pipes),
+                    '-filter_complex', filter_complex,
+                    '-y',
+                    output_path
+                ]
+
+            # Выполняем команду
+            with METRICS.stage('ffmpeg') as stage:
+                FFmpegHandler._run(command, pipe_data=FFmpegHandler._mark_data(mark),
+                                   timeout=config.get('timeout'))
+                if METRICS.enabled:
+                    stage.add(bytes_read=os.path.getsize(input_path),
+                              bytes_written=os.path.getsize(output_path))
+            
+            return True
+
+        except Exception as e:
+            print(f"Ошибка обработки изображения: {e}")
+            return False
+
+    @staticmethod
+    def render(source, watermark_path, config, output_format='png'):
+        """Накладывает водяной знак без файлов на диске и возвращает закодированный результат.
+
+        source — путь, закодированное изображение (bytes) или изображение Pillow;
+        байты и изображение передаются ffmpeg через stdin, результат читается из stdout.
+        """
+        ffmpeg_path = '/opt/homebrew/bin/ffmpeg' if sys.platform == 'darwin' else 'ffmpeg'
+        codec = FFmpegHandler.OUTPUT_CODECS.get(output_format.lower().lstrip('.'))
+        if codec is None:
+            raise Exception(f"Неподдерживаемый формат результата: {output_format}")
+
+        stdin = None
+        if isinstance(source, Image.Image):
+            if source.mode not in ('RGB', 'RGBA'):
+                source = source.convert('RGBA')
+            size = source.size
+            pix_fmt = 'rgba' if source.mode == 'RGBA' else 'rgb24'
+            source_input = ['-f', 'rawvideo', '-pix_fmt', pix_fmt, '-s', f'{size[0]}x{size[1]}',
+                            '-i', 'pipe:0']
+            stdin = source.tobytes()
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            # Из заголовка узнаем только размер, декодирует ffmpeg
+            with Image.open(io.BytesIO(source)) as img:
+                size = img.size
+            source_input = ['-i', 'pipe:0']
+            stdin = bytes(source)
+        else:
+            size = FFmpegHandler.get_dimensions(source)
+            if not all(size):
+                raise Exception("Не удалось получить размеры изображения")
+            source_input = ['-i', source]
+
+        mark, filter_complex = FFmpegHandler.overlay_filter(
+            watermark_path, size, config, in_memory=FFmpegHandler.PIPE_INPUTS
+        )
+
+        def command(pipes):
+            return [
+                ffmpeg_path, '-v', 'error',
+                *source_input,
+                *FFmpegHandler._mark_input(mark, pipes),
                 '-filter_complex', filter_complex,
-                '-y',
-                output_path
+                '-f', 'image2pipe', '-c:v', codec, '-frames:v', '1',
+                'pipe:1'
             ]
 
-            # Выполняем команду
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            _, stderr = process.communicate()
+        with METRICS.stage('ffmpeg') as stage:
+            output = FFmpegHandler._run(command, stdin=stdin,
+                                        pipe_data=FFmpegHandler._mark_data(mark),
+                                        timeout=config.get('timeout'))
+            stage.add(bytes_read=len(stdin or b''), bytes_written=len(output))
+        return output
+
+    @staticmethod
+    def overlay_filter(watermark_path, size, config, in_memory=False):
+        """Готовый водяной знак под размер кадра и граф наложения, возвращает (знак, filter_complex)"""
+        mark, positions = FFmpegHandler.overlay_mark(watermark_path, size, config, in_memory)
+        return mark, FFmpegHandler._create_batch_filter_complex(1, positions, labeled=False)
+
+    @staticmethod
+    def overlay_mark(watermark_path, size, config, in_memory=False):
+        """Готовый водяной знак под размер кадра и позиции наложения, возвращает (знак, позиции).
+
+        Знак — пара (размер, байты RGBA) из кэша при in_memory, иначе путь к PNG.
+        """
+        if config['tile_enabled'] and LAYER_CACHE.fits(size, raw=in_memory):
+            # Слой со всей сеткой берем из кэша: одно наложение вместо density²
+            cache, positions = LAYER_CACHE, ['0:0']
+        elif config['tile_enabled']:
+            # Слой не помещается в кэш: строить его заново для каждого кадра дороже,
+            # чем наложить сам знак во всех позициях сетки
+            mark_size = SCALED_CACHE.get(watermark_path, None, size, config).size
+            cache = SCALED_CACHE
+            positions = [f'{x}:{y}' for x, y in PillowHandler._positions(size, mark_size, True,
+                                                                         config['density'])]
+        else:
+            # Масштаб и прозрачность уже применены: ffmpeg только накладывает
+            cache, positions = SCALED_CACHE, [FFmpegHandler.CENTER_POSITION]
+        if in_memory:
+            return cache.get_raw(watermark_path, None, size, config), positions
+        return cache.get_file(watermark_path, None, size, config), positions
+
+    @staticmethod
+    def _mark_input(mark, pipes):
+        """Аргументы входа ffmpeg для водяного знака: несжатый RGBA из канала или файл"""
+        if isinstance(mark, tuple):
+            (width, height), _ = mark
+            return ['-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f'{width}x{height}',
+                    '-i', pipes[0]]
+        return ['-i', mark]
+
+    @staticmethod
+    def _mark_data(mark):
+        return [mark[1]] if isinstance(mark, tuple) else []
+
+    @staticmethod
+    def _run(command, stdin=None, pipe_data=(), timeout=None):
+        """Запускает ffmpeg и возвращает stdout.
+
+        command получает адреса каналов pipe:N, через которые передаются pipe_data;
+        данные пишутся из отдельных потоков, чтобы ffmpeg мог читать входы в любом порядке.
+        """
+        pipes = [os.pipe() for _ in pipe_data]
+        writers = []
+        try:
+            process = subprocess.Popen(command([f'pipe:{read_fd}' for read_fd, _ in pipes]),
+                                       stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       pass_fds=[read_fd for read_fd, _ in pipes])
+        except Exception:
+            for read_fd, write_fd in pipes:
+                os.close(read_fd)
+                os.close(write_fd)
+            raise
+
+        for (read_fd, write_fd), data in zip(pipes, pipe_data):
+            # Читающий конец остался только у ffmpeg: при его завершении запись прервется
+            os.close(read_fd)
+            writer = threading.Thread(target=FFmpegHandler._feed, args=(write_fd, data), daemon=True)
+            writer.start()
+            writers.append(writer)
+
+        try:
+            stdout, stderr = process.communicate(stdin, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise Exception("Превышено время ожидания ffmpeg")
+        finally:
+            for writer in writers:
+                writer.join()
+
+        if process.returncode != 0:
+            raise Exception(f"FFmpeg error: {stderr.decode(errors='replace')}")
+        return stdout
+
+    @staticmethod
+    def _feed(fd, data):
+        try:
+            with open(fd, 'wb') as f:
+                f.write(data)
+        except (BrokenPipeError, OSError):
+            # ffmpeg завершился раньше, чем прочитал вход; ошибку покажет код возврата
+            pass
+
+    @staticmethod
+    def apply_watermark_batch(items, watermark_path, config):
+        """Накладывает водяной знак на группу изображений одного размера одним процессом ffmpeg"""
+        if len(items) == 1:
+            input_path, output_path = items[0]
+            return [FFmpegHandler.apply_watermark(input_path, watermark_path, output_path, config)]
+
+        ffmpeg_path = '/opt/homebrew/bin/ffmpeg' if sys.platform == 'darwin' else 'ffmpeg'
+        try:
+            width, height = FFmpegHandler.get_dimensions(items[0][0])
+            if not width or not height:
+                raise Exception("Не удалось получить размеры изображения")
+
+            # Водяной знак подготовлен один раз на всю группу
+            mark, positions = FFmpegHandler.overlay_mark(watermark_path, (width, height), config,
+                                                         in_memory=FFmpegHandler.PIPE_INPUTS)
+            filter_complex = FFmpegHandler._create_batch_filter_complex(len(items), positions)
+
+            # Формируем команду: N входов, водяной знак последним, N выходов
+            def command(pipes):
+                command = [ffmpeg_path, '-y']
+                for input_path, _ in items:
+                    command += ['-i', input_path]
+                command += [*FFmpegHandler._mark_input(mark, pipes), '-filter_complex', filter_complex]
+                for index, (_, output_path) in enumerate(items):
+                    command += ['-map', f'[o{index}]', output_path]
+                return command
+
+            with METRICS.stage('ffmpeg_batch') as stage:
+                timeout = config.get('timeout')
+                FFmpegHandler._run(command, pipe_data=FFmpegHandler._mark_data(mark),
+                                   timeout=timeout * len(items) if timeout else None)
+
+                results = [os.path.exists(output_path) and os.path.getsize(output_path) > 0
+                           for _, output_path in items]
+                if METRICS.enabled:
+                    stage.add(bytes_read=sum(os.path.getsize(i) for i, _ in items),
+                              bytes_written=sum(os.path.getsize(o) for (_, o), ok
+                                                in zip(items, results) if ok))
+
+        except Exception as e:
+            # Один испорченный файл не должен ронять всю группу: повторяем по одному
+            print(f"Ошибка пакетной обработки, обрабатываем по одному: {e}")
+            results = [False] * len(items)
+
+        return [
+            success or FFmpegHandler.apply_watermark(input_path, watermark_path, output_path, config)
+            for success, (input_path, output_path) in zip(results, items)
+        ]
+
+    @staticmethod
+    def _create_batch_filter_complex(count, positions, labeled=True):
+        """Создает filter_complex: готовый водяной знак (вход count) накладывается на каждый вход во всех позициях.
+
+        Выход входа i — [o{i}]; без labeled единственный выход остается без метки,
+        как ожидают одиночные команды и видео.
+        """
+        total = count * len(positions)
+        if total == 1:
+            marks, filter_parts = [f'[{count}:v]'], []
+        else:
+            marks = [f'[w{i}]' for i in range(total)]
+            filter_parts = [f'[{count}:v]split={total}' + ''.join(marks)]
+
+        for i in range(count):
+            current = f'[{i}:v]'
+            for j, position in enumerate(positions):
+                if j < len(positions) - 1:
+                    output = f'[t{i}_{j}]'
+                else:
+                    output = f'[o{i}]' if labeled else ''
+                filter_parts.append(f'{current}{marks[i * len(positions) + j]}overlay={position}{output}')
+                current = output
+        return ';'.join(filter_parts)
+
+class VideoHandler:
+    """Наложение водяного знака на видео MP4/MOV через ffmpeg.
+
+    Длинные ролики режутся по ключевым кадрам на сегменты, которые кодируются
+    параллельно и склеиваются без перекодирования; звук копируется как есть.
+    """
+    VIDEO_CODEC = ['-c:v', 'libx264', '-crf', '18', '-preset', 'medium', '-pix_fmt', 'yuv420p']
+    # Сегменты короче этого не выделяем: запуск ffmpeg и ключевые кадры съедят выигрыш
+    MIN_SEGMENT_SECONDS = 10.0
+
+    @staticmethod
+    def _ffmpeg():
+        return '/opt/homebrew/bin/ffmpeg' if sys.platform == 'darwin' else 'ffmpeg'
+
+    @staticmethod
+    def _ffprobe():
+        return '/opt/homebrew/bin/ffprobe' if sys.platform == 'darwin' else 'ffprobe'
+
+    @staticmethod
+    def probe(video_path):
+        """Размеры кадра после поворота и длительность в секундах.
+
+        ffmpeg по умолчанию поворачивает кадры по матрице отображения, поэтому водяной знак
+        строится под повернутый кадр: у вертикального ролика с телефона ширина и высота меняются местами.
+        """
+        command = [
+            VideoHandler._ffprobe(), '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'stream=width,height:stream_side_data=rotation:stream_tags=rotate'
+                             ':format=duration',
+            '-of', 'json',
+            video_path
+        ]
+        info = json.loads(subprocess.check_output(command))
+        stream = info['streams'][0]
+        width, height = stream['width'], stream['height']
+        # Старые версии ffmpeg отдают поворот тегом rotate, новые — в side data
+        rotation = stream.get('tags', {}).get('rotate', 0)
+        for side_data in stream.get('side_data_list', []):
+            rotation = side_data.get('rotation', rotation)
+        if int(float(rotation)) % 180:
+            width, height = height, width
+        return width, height, float(info['format']['duration'])
+
+    @staticmethod
+    def keyframes(video_path):
+        """Время ключевых кадров; читаются только пакеты, без декодирования"""
+        command = [
+            VideoHandler._ffprobe(), '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags',
+            '-of', 'csv=p=0',
+            video_path
+        ]
+        times = []
+        for line in subprocess.check_output(command).decode().splitlines():
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags and pts_time not in ('', 'N/A'):
+                times.append(float(pts_time))
+        return sorted(times)
+
+    @staticmethod
+    def plan_segments(duration, keyframes, count):
+        """Границы сегментов [(начало, длительность или None)], разрезы только по ключевым кадрам"""
+        count = min(count, int(duration // VideoHandler.MIN_SEGMENT_SECONDS))
+        cuts = []
+        for index in range(1, max(count, 1)):
+            target = duration * index / count
+            # Ближайший к равному делению ключевой кадр; сегменты по обе стороны разреза
+            # не короче минимума
+            previous = cuts[-1] if cuts else 0.0
+            candidates = [k for k in keyframes
+                          if k - previous >= VideoHandler.MIN_SEGMENT_SECONDS
+                          and duration - k >= VideoHandler.MIN_SEGMENT_SECONDS]
+            if candidates:
+                cut = min(candidates, key=lambda k: abs(k - target))
+                if cut > previous:
+                    cuts.append(cut)
+
+        starts = [0.0] + cuts
+        ends = cuts + [None]
+        return [(start, end - start if end is not None else None) for start, end in zip(starts, ends)]
+
+    @staticmethod
+    def apply_watermark(input_path, watermark_path, output_path, config, progress=None,
+                        workers=None, cancel_event=None):
+        """Накладывает водяной знак на видео; progress получает долю готовности от 0 до 1"""
+        try:
+            width, height, duration = VideoHandler.probe(input_path)
+            mark_path, filter_complex = FFmpegHandler.overlay_filter(watermark_path,
+                                                                     (width, height), config)
+            workers = workers or os.cpu_count() or 1
+            segments = [(0.0, None)]
+            if workers > 1 and duration >= 2 * VideoHandler.MIN_SEGMENT_SECONDS:
+                with METRICS.stage('keyframes'):
+                    segments = VideoHandler.plan_segments(duration, VideoHandler.keyframes(input_path),
+                                                          workers)
+
+            # Готовность по каждому сегменту в секундах выходного видео
+            done = [0.0] * len(segments)
+            lock = threading.Lock()
+
+            def advance(index, seconds):
+                with lock:
+                    done[index] = seconds
+                    total = sum(done)
+                if progress is not None and duration:
+                    progress(min(1.0, total / duration))
+
+            if len(segments) == 1:
+                # Короткий ролик кодируем сразу в результат вместе со звуком
+                command = VideoHandler._encode_command(input_path, mark_path, filter_complex,
+                                                       None, None, output_path, audio=True)
+                with METRICS.stage('video_encode'):
+                    VideoHandler._run(command, lambda seconds: advance(0, seconds), cancel_event)
+                return True
+
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(output_path) or '.',
+                                             prefix='.tmp-segments-') as temp_dir:
+                paths = [os.path.join(temp_dir, f'segment_{index:03d}.mp4')
+                         for index in range(len(segments))]
+                # Потоки кодировщика делим между одновременно работающими сегментами
+                threads = max(1, (os.cpu_count() or 1) // len(segments))
+                with METRICS.stage('video_encode'), \
+                        ThreadPoolExecutor(max_workers=len(segments)) as pool:
+                    futures = [
+                        pool.submit(VideoHandler._run,
+                                    VideoHandler._encode_command(input_path, mark_path,
+                                                                 filter_complex, start, length,
+                                                                 path, threads=threads),
+                                    lambda seconds, index=index: advance(index, seconds),
+                                    cancel_event)
+                        for index, ((start, length), path) in enumerate(zip(segments, paths))
+                    ]
+                    for future in futures:
+                        future.result()
+
+                list_path = os.path.join(temp_dir, 'segments.txt')
+                with open(list_path, 'w', encoding='utf-8') as f:
+                    # Кавычки внутри пути экранируются по правилам concat: ' -> '\''
+                    f.writelines("file '{}'\n".format(path.replace("'", "'\\''")) for path in paths)
+                with METRICS.stage('video_concat'):
+                    VideoHandler._run(VideoHandler._concat_command(list_path, input_path, output_path),
+                                      None, cancel_event)
+            return True
+
+        except Exception as e:
+            print(f"Ошибка обработки видео: {e}")
+            return False
 
+    @staticmethod
+    def _encode_command(input_path, mark_path, filter_complex, start, length, output_path,
+                        audio=False, threads=None):
+        command = [VideoHandler._ffmpeg(), '-y', '-v', 'error', '-nostats', '-progress', 'pipe:1']
+        if start:
+            # Начало сегмента совпадает с ключевым кадром, поэтому поиск по входу точный
+            command += ['-ss', f'{start:.6f}']
+        if length is not None:
+            command += ['-t', f'{length:.6f}']
+        command += ['-i', input_path, '-i', mark_path,
+                    '-filter_complex', f'{filter_complex}[v]', '-map', '[v]']
+        if audio:
+            command += ['-map', '0:a?', '-c:a', 'copy']
+        else:
+            command += ['-an']
+        command += VideoHandler.VIDEO_CODEC
+        if threads:
+            command += ['-threads', str(threads)]
+        return command + [output_path]
+
+    @staticmethod
+    def _concat_command(list_path, input_path, output_path):
+        """Склейка сегментов без перекодирования, звук берется из исходного файла"""
+        return [
+            VideoHandler._ffmpeg(), '-y', '-v', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-i', input_path,
+            '-map', '0:v', '-map', '1:a?',
+            '-c', 'copy',
+            '-map_metadata', '1',
+            '-movflags', '+faststart',
+            output_path
+        ]
+
+    @staticmethod
+    def _run(command, on_progress, cancel_event=None):
+        """Запускает ffmpeg и передает время из -progress в on_progress (в секундах)"""
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                for line in process.stdout:
+                    if cancel_event is not None and cancel_event.is_set():
+                        process.kill()
+                        break
+                    key, _, value = line.decode().strip().partition('=')
+                    if key == 'out_time_us' and on_progress is not None and value.isdigit():
+                        on_progress(int(value) / 1_000_000)
+            finally:
+                process.stdout.close()
+                process.wait()
+
+            if cancel_event is not None and cancel_event.is_set():
+                raise Exception("Обработка видео отменена")
             if process.returncode != 0:
-                raise Exception(f"FFmpeg error: {stderr.decode()}")
-            
+                stderr.seek(0)
+                raise Exception(f"FFmpeg error: {stderr.read().decode(errors='replace')}")
+
+class PillowHandler:
+    """Класс для наложения водяного знака внутри процесса (без ffmpeg)"""
+    JPEG_QUALITY = 95
+    # Бюджет памяти на рабочие буферы; большие кадры обрабатываются полосами
+    MEMORY_BUDGET = 256 * 1024 * 1024
+    # Панорамы на сотни мегапикселей — обычный вход; Pillow предупреждает выше этого
+    # предела и отказывается открывать файлы вдвое больше
+    MAX_IMAGE_PIXELS = 500 * 1000 * 1000
+
+    @staticmethod
+    def get_dimensions(image_path):
+        """Получает размеры изображения (читается только заголовок файла)"""
+        with METRICS.stage('probe'):
+            return METADATA_INDEX.dimensions(image_path)
+
+    @staticmethod
+    def apply_watermark(input_path, watermark_path, output_path, config):
+        """Накладывает водяной знак на изображение"""
+        try:
+            watermark = PillowHandler._load_watermark(watermark_path)
+            with Image.open(input_path) as source:
+                with METRICS.stage('decode') as stage:
+                    source.load()
+                    if METRICS.enabled:
+                        stage.add(bytes_read=os.path.getsize(input_path))
+                with METRICS.stage('composite'):
+                    result, mode = PillowHandler.render(source, watermark, watermark_path,
+                                                        config, output_path, in_place=True)
+                with METRICS.stage('encode') as stage:
+                    PillowHandler._save(result, output_path, mode)
+                    if METRICS.enabled:
+                        stage.add(bytes_written=os.path.getsize(output_path))
             return True
 
         except Exception as e:
@@ -82,175 +1023,2075 @@ class FFmpegHandler:
             return False
 
     @staticmethod
-    def _create_filter_complex(scale, opacity, tile_enabled, density):
-        """Создает строку filter_complex для ffmpeg"""
-        if tile_enabled:
-            filter_parts = []
-            filter_parts.append(f'[1:v]scale={scale}:-1[scaled]')
-            filter_parts.append(f'[scaled]format=rgba,colorchannelmixer=aa={opacity}[watermark]')
-            
-            total_marks = density * density
-            splits = [f'[watermark]split={total_marks}']
-            splits.extend(f'[w{i}]' for i in range(total_marks))
-            filter_parts.append(''.join(splits))
-            
-            current = '[0:v]'
-            overlays = []
-            for row in range(density):
-                for col in range(density):
-                    mark_idx = row * density + col
-                    out_name = f'[v{mark_idx}]' if mark_idx < total_marks - 1 else ''
-                    x_pos = f'(W-w)*{col}/{density-1}'
-                    y_pos = f'(H-h)*{row}/{density-1}'
-                    overlays.append(
-                        f'{current}[w{mark_idx}]overlay={x_pos}:{y_pos}{out_name}'
-                    )
-                    current = out_name
-            
-            filter_parts.extend(overlays)
-            return ';'.join(filter_parts)
+    def apply_variants(input_path, output_paths, config):
+        """Создает все варианты (config['variants']) из одного декодирования исходника"""
+        try:
+            variants = config['variants']
+            with Image.open(input_path) as source:
+                size = source.size
+                limits = [variant['max_size'] for variant in variants]
+                if None not in limits:
+                    # JPEG сразу декодируется в меньшем масштабе, достаточном для самого большого варианта
+                    scale = min(1.0, max(limits) / max(size))
+                    source.draft(source.mode, (math.ceil(size[0] * scale), math.ceil(size[1] * scale)))
+                with METRICS.stage('decode') as stage:
+                    source.load()
+                    if METRICS.enabled:
+                        stage.add(bytes_read=os.path.getsize(input_path))
+
+                for variant, output_path in zip(variants, output_paths):
+                    watermark = PillowHandler._load_watermark(variant['watermark_path'])
+                    variant_config = dict(config, **variant['config'])
+                    with METRICS.stage('resize'):
+                        image = PillowHandler._resize(source, size, variant['max_size'])
+                    with METRICS.stage('composite'):
+                        result, mode = PillowHandler.render(image, watermark, variant['watermark_path'],
+                                                            variant_config, output_path)
+                    with METRICS.stage('encode') as stage:
+                        PillowHandler._save(result, output_path, mode, quality=variant['quality'])
+                        if METRICS.enabled:
+                            stage.add(bytes_written=os.path.getsize(output_path))
+            return True
+
+        except Exception as e:
+            print(f"Ошибка обработки изображения: {e}")
+            return False
+
+    @staticmethod
+    def _resize(image, size, max_size):
+        """Уменьшает до max_size по длинной стороне; размер считается от исходного кадра size,
+        поэтому не зависит от масштаба, в котором JPEG был декодирован"""
+        if max_size is None or max(size) <= max_size:
+            target = size
         else:
-            return (
-                f'[1:v]scale={scale}:-1[watermark];'
-                f'[watermark]format=rgba,colorchannelmixer=aa={opacity}[watermark_alpha];'
-                '[0:v][watermark_alpha]overlay=(main_w-overlay_w)/2:(main_h-overlay_h)/2'
-            )
+            scale = max_size / max(size)
+            target = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+        if image.size == target:
+            return image
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        return image.resize(target, Image.LANCZOS)
+
+    @staticmethod
+    def render(source, watermark, watermark_key, config, output_path, in_place=False):
+        """Накладывает водяной знак на загруженное изображение, возвращает (результат, режим).
+
+        При in_place большой кадр может быть изменен на месте, чтобы не держать вторую копию.
+        """
+        has_alpha = 'A' in source.getbands() or 'transparency' in source.info
+        mode = PillowHandler._output_mode(output_path, has_alpha)
+        budget = config.get('memory_budget') or PillowHandler.MEMORY_BUDGET
+
+        # Полный кадр требует RGBA-копию и результат в выходном режиме (до 4 байт на пиксель каждый)
+        if source.width * source.height * 8 > budget:
+            result = PillowHandler.composite_strips(source, watermark, config, mode, budget,
+                                                    watermark_key=watermark_key, in_place=in_place)
+            return result, mode
+        result = PillowHandler.composite(source.convert('RGBA'), watermark, config,
+                                         watermark_key=watermark_key)
+        return result, mode
+
+    @staticmethod
+    def composite(image, watermark, config, watermark_key=None):
+        """Накладывает водяной знак на RGBA-изображение: сетку или один знак по центру.
+
+        Знак из кэша накладывается только на свою область, поэтому это быстрее, чем смешивать
+        слой на весь кадр; готовые слои нужны только графу ffmpeg.
+        """
+        width, height = image.size
+        mark = PillowHandler._scaled_mark(watermark, watermark_key, image.size, config)
+
+        for x, y in PillowHandler._positions((width, height), mark.size,
+                                             config['tile_enabled'], config['density']):
+            PillowHandler._overlay(image, mark, x, y)
+        return image
+
+    @staticmethod
+    def composite_strips(source, watermark, config, mode, budget, watermark_key=None, in_place=False):
+        """Накладывает водяной знак горизонтальными полосами в пределах бюджета памяти.
+
+        Результат совпадает с composite: геометрия считается по всему кадру,
+        а наложение попиксельное, поэтому обрезка по полосам его не меняет.
+        """
+        width, height = source.size
+        mark = PillowHandler._scaled_mark(watermark, watermark_key, source.size, config)
+        positions = PillowHandler._positions((width, height), mark.size,
+                                             config['tile_enabled'], config['density'])
+
+        # На строку: RGBA-полоса и полоса в выходном режиме
+        rows = max(1, budget // (width * 8))
+        # Если исходник больше не нужен и режим совпадает, результат пишется прямо в него
+        result = source if in_place and source.mode == mode else Image.new(mode, source.size)
+
+        for top in range(0, height, rows):
+            bottom = min(top + rows, height)
+            strip = source.crop((0, top, width, bottom)).convert('RGBA')
+            for x, y in positions:
+                if y < bottom and y + mark.height > top:
+                    PillowHandler._overlay(strip, mark, x, y - top)
+
+            result.paste(strip if mode == 'RGBA' else strip.convert(mode), (0, top))
+        return result
+
+    @staticmethod
+    def build_layer(watermark, size, config, watermark_key=None):
+        """Создает прозрачный слой размером с кадр со всеми водяными знаками"""
+        layer = Image.new('RGBA', size, (0, 0, 0, 0))
+        mark = PillowHandler._scaled_mark(watermark, watermark_key, size, config)
+        for x, y in PillowHandler._positions(size, mark.size, config['tile_enabled'], config['density']):
+            PillowHandler._overlay(layer, mark, x, y)
+        return layer
+
+    @staticmethod
+    def _mark_scale(size, config):
+        """Ширина водяного знака для кадра, как в apply_watermark у ffmpeg"""
+        return min(size) * (0.15 if config['tile_enabled'] else 0.3)
+
+    @staticmethod
+    def _scaled_mark(watermark, watermark_key, size, config):
+        """Масштабированный водяной знак с прозрачностью; при известном ключе берется из кэша"""
+        if watermark_key is not None:
+            return SCALED_CACHE.get(watermark_key, watermark, size, config)
+        return PillowHandler._prepare_watermark(watermark, PillowHandler._mark_scale(size, config),
+                                                config['opacity'])
+
+    @staticmethod
+    def _prepare_watermark(watermark, scale, opacity):
+        """Аналог scale={scale}:-1 и colorchannelmixer=aa={opacity}"""
+        # ffmpeg отбрасывает дробную часть ширины, а высоту округляет с сохранением пропорций
+        width = max(1, int(scale))
+        height = max(1, int(watermark.height * width / watermark.width + 0.5))
+        mark = watermark.resize((width, height), Image.BICUBIC)
+
+        alpha = mark.getchannel('A').point(lambda a: int(a * opacity + 0.5))
+        mark.putalpha(alpha)
+        return mark
+
+    @staticmethod
+    def _positions(frame_size, mark_size, tile_enabled, density):
+        """Координаты водяных знаков в том же порядке, что и цепочка overlay в ffmpeg"""
+        free_w = frame_size[0] - mark_size[0]
+        free_h = frame_size[1] - mark_size[1]
+        if not tile_enabled:
+            return [(PillowHandler._even(free_w / 2), PillowHandler._even(free_h / 2))]
+
+        return [
+            (PillowHandler._even(free_w * col / (density - 1)),
+             PillowHandler._even(free_h * row / (density - 1)))
+            for row in range(density)
+            for col in range(density)
+        ]
+
+    @staticmethod
+    def _even(value):
+        """Overlay в ffmpeg отбрасывает дробную часть и выравнивает координату по чётности (yuv420)"""
+        return int(value) & ~1
+
+    @staticmethod
+    def _overlay(image, mark, x, y):
+        """Накладывает mark на image в точке (x, y) с обрезкой по границам кадра"""
+        left, top = max(x, 0), max(y, 0)
+        right = min(x + mark.width, image.width)
+        bottom = min(y + mark.height, image.height)
+        if left >= right or top >= bottom:
+            return
+        image.alpha_composite(mark, (left, top), (left - x, top - y, right - x, bottom - y))
+
+    @staticmethod
+    def _output_mode(output_path, keep_alpha):
+        """Режим результата: альфа-канал сохраняется только там, где формат его поддерживает"""
+        ext = os.path.splitext(output_path)[1].lower()
+        if ext in ('.jpg', '.jpeg') or not keep_alpha:
+            return 'RGB'
+        return 'RGBA'
+
+    @staticmethod
+    def _save(image, output_path, mode, quality=None):
+        """Сохраняет результат в формате, соответствующем расширению файла"""
+        if image.mode != mode:
+            image = image.convert(mode)
+        ext = os.path.splitext(output_path)[1].lower()
+        if ext in ('.jpg', '.jpeg'):
+            image.save(output_path, 'JPEG', quality=quality or PillowHandler.JPEG_QUALITY)
+        elif ext == '.webp' and quality is not None:
+            image.save(output_path, quality=quality)
+        else:
+            image.save(output_path)
+
+    @staticmethod
+    @lru_cache(maxsize=4)
+    def _load_watermark(watermark_path):
+        """Загружает водяной знак один раз на весь пакет"""
+        # Отрисованный в этом процессе водяной знак берем из памяти без декодирования PNG
+        rendered = WatermarkCreator.rendered(watermark_path)
+        if rendered is not None:
+            return rendered
+        with Image.open(watermark_path) as img:
+            return img.convert('RGBA')
+
+class WatermarkLayerCache:
+    """LRU-кэш готовых слоев водяного знака на весь кадр для тайлинга в ffmpeg"""
+    DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # ключ -> {'layer', 'path', 'raw', 'bytes'}
+        self._bytes = 0
+        # Файлы вытесненных записей: ffmpeg может еще читать их, удаляются в purge_retired()
+        self._retired_paths = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(watermark_key, size, config):
+        return (watermark_key, size[0], size[1], config['opacity'], config['density'])
+
+    @staticmethod
+    def _build(watermark_key, watermark, size, config):
+        return PillowHandler.build_layer(watermark, size, config, watermark_key=watermark_key)
+
+    def fits(self, size, raw=False):
+        """Поместится ли слой для кадра size (вместе с несжатыми байтами при raw) в кэш"""
+        return size[0] * size[1] * 4 * (2 if raw else 1) <= self.max_bytes
+
+    def get(self, watermark_key, watermark, size, config):
+        """Возвращает слой для заданного разрешения, создавая его при промахе"""
+        return self._get_entry(watermark_key, watermark, size, config)['layer']
+
+    def get_file(self, watermark_key, watermark, size, config):
+        """Возвращает путь к PNG со слоем (для ffmpeg), сохраняя его один раз"""
+        entry = self._get_entry(watermark_key, watermark, size, config)
+        with self._lock:
+            if entry['path'] is None:
+                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
+                temp_file.close()
+                entry['layer'].save(temp_file.name, 'PNG')
+                entry['path'] = temp_file.name
+            return entry['path']
+
+    def get_raw(self, watermark_key, watermark, size, config):
+        """Возвращает (размер, несжатые байты RGBA) слоя, получая байты один раз на запись"""
+        entry = self._get_entry(watermark_key, watermark, size, config)
+        with self._lock:
+            if entry['raw'] is None:
+                entry['raw'] = entry['layer'].tobytes()
+                # Байты учитываются в объеме записи, только если она в кэше
+                if self._entries.get(self._key(watermark_key, size, config)) is entry:
+                    entry['bytes'] += len(entry['raw'])
+                    self._bytes += len(entry['raw'])
+                    self._evict()
+            return entry['layer'].size, entry['raw']
+
+    def _get_entry(self, watermark_key, watermark, size, config):
+        key = self._key(watermark_key, size, config)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        if watermark is None:
+            watermark = PillowHandler._load_watermark(watermark_key)
+        layer = self._build(watermark_key, watermark, size, config)
+        entry = {'layer': layer, 'path': None, 'raw': None, 'bytes': layer.width * layer.height * 4}
+
+        with self._lock:
+            if entry['bytes'] > self.max_bytes:
+                # Слой больше всего кэша: используем без сохранения
+                return entry
+            existing = self._entries.get(key)
+            if existing is not None:
+                return existing
+            self._entries[key] = entry
+            self._bytes += entry['bytes']
+            self._evict()
+        return entry
+
+    def _evict(self):
+        # Вызывается под блокировкой; последнюю запись не вытесняем
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._release(evicted)
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """Меняет предел кэша, вытесняя записи сверх него"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _release(self, entry):
+        self._bytes -= entry['bytes']
+        if entry['path']:
+            self._retired_paths.append(entry['path'])
+
+    def reset_stats(self):
+        """Обнуляет счетчики; записи кэша остаются"""
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Возвращает счетчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def clear(self):
+        """Очищает кэш и удаляет временные файлы"""
+        with self._lock:
+            while self._entries:
+                _, entry = self._entries.popitem(last=False)
+                self._release(entry)
+        self.purge_retired()
+
+    def purge_retired(self):
+        """Удаляет файлы вытесненных записей; вызывается, когда задачи, которые могли их читать, завершены"""
+        with self._lock:
+            paths, self._retired_paths = self._retired_paths, []
+        for path in paths:
+            if os.path.exists(path):
+                try:
+                    os.unlink(path)
+                except Exception as e:
+                    print(f"Ошибка удаления временного файла: {e}")
+
+class ScaledWatermarkCache(WatermarkLayerCache):
+    """LRU-кэш водяного знака, уже масштабированного под размер кадра и с примененной прозрачностью"""
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__(max_bytes)
+
+    @staticmethod
+    def _key(watermark_key, size, config):
+        # Кадры с одинаковой меньшей стороной используют один вариант
+        return (watermark_key, int(PillowHandler._mark_scale(size, config)), config['opacity'])
+
+    @staticmethod
+    def _build(watermark_key, watermark, size, config):
+        return PillowHandler._prepare_watermark(watermark, PillowHandler._mark_scale(size, config),
+                                                config['opacity'])
+
+Image.MAX_IMAGE_PIXELS = PillowHandler.MAX_IMAGE_PIXELS
+
+# Общие кэши слоев и масштабированных вариантов для текущего процесса
+LAYER_CACHE = WatermarkLayerCache()
+SCALED_CACHE = ScaledWatermarkCache()
+
+def _configure_caches(config):
+    """Делит бюджет кэшей процесса между слоями и масштабированными знаками в пропорции их пределов по умолчанию"""
+    budget = config.get('cache_budget')
+    if not budget:
+        return
+    layer_bytes = budget * WatermarkLayerCache.DEFAULT_MAX_BYTES // (
+        WatermarkLayerCache.DEFAULT_MAX_BYTES + ScaledWatermarkCache.DEFAULT_MAX_BYTES)
+    LAYER_CACHE.resize(layer_bytes)
+    SCALED_CACHE.resize(budget - layer_bytes)
+
+# Доступные движки обработки
+ENGINES = {
+    'ffmpeg': FFmpegHandler,
+    'pillow': PillowHandler,
+}
+
+class JobTimeout(Exception):
+    """Превышено время обработки одного изображения"""
+
+def _job_timeout(signum, frame):
+    raise JobTimeout()
+
+def _init_worker():
+    """Ctrl+C обрабатывает главный процесс, рабочие дорабатывают текущую задачу"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # После fork счетчики кэшей унаследованы от главного процесса, и сводка метрик,
+    # складывающая процессы, посчитала бы их дважды
+    WatermarkCreator.reset_cache_info()
+
+def _temp_output_path(output_path):
+    """Временный путь рядом с результатом; расширение сохраняется для выбора формата"""
+    directory, name = os.path.split(output_path)
+    return os.path.join(directory, f".tmp-{os.getpid()}-{threading.get_ident()}-{name}")
+
+def _job_fingerprint(input_path, config):
+    """Отпечаток входного файла для манифеста, если он нужен; заодно прогревает кэш страниц перед декодированием"""
+    if not config.get('fingerprint'):
+        return None
+    with METRICS.stage('fingerprint'):
+        return ProcessingManifest.fingerprint(input_path)
+
+def _process_job(engine, input_path, watermark_path, output_path, config):
+    """Обрабатывает одно изображение (выполняется в рабочем процессе или потоке).
+
+    Возвращает False при ошибке; при config['fingerprint'] успех — отпечаток входного файла.
+    """
+    fingerprint = _job_fingerprint(input_path, config)
+    timeout = config.get('timeout')
+    use_alarm = engine != 'ffmpeg' and timeout and hasattr(signal, 'SIGALRM') \
+        and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        # Ограничиваем время задачи внутри рабочего процесса
+        signal.signal(signal.SIGALRM, _job_timeout)
+        signal.alarm(int(timeout))
+
+    # Пишем во временный файл и переименовываем только после успеха,
+    # чтобы сбой не оставил недописанный watermarked_* файл
+    variants = config.get('variants')
+    output_paths = OutputVariants.outputs(input_path, output_path, variants) if variants \
+        else [output_path]
+    temp_paths = [_temp_output_path(path) for path in output_paths]
+    success = False
+    METRICS.ensure(config)
+    _configure_caches(config)
+    try:
+        with METRICS.image(input_path) as record:
+            if variants:
+                success = ENGINES[engine].apply_variants(input_path, temp_paths, config)
+            else:
+                success = ENGINES[engine].apply_watermark(input_path, watermark_path, temp_paths[0],
+                                                          config)
+            if success:
+                # Первый вариант переименовываем последним: по нему манифест судит о готовности
+                for temp_path, path in reversed(list(zip(temp_paths, output_paths))):
+                    os.replace(temp_path, path)
+            record.success = success
+        METRICS.record_caches(WatermarkCreator.cache_info())
+        return (fingerprint or success) if success else False
+    except JobTimeout:
+        print(f"Превышено время обработки: {input_path}")
+        return False
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+        if not success:
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+
+def _process_group(engine, items, watermark_path, config):
+    """Обрабатывает группу изображений одного размера одним вызовом движка"""
+    if len(items) == 1:
+        input_path, output_path = items[0]
+        return [_process_job(engine, input_path, watermark_path, output_path, config)]
+
+    fingerprints = [_job_fingerprint(input_path, config) for input_path, _ in items]
+    temp_items = [(input_path, _temp_output_path(output_path)) for input_path, output_path in items]
+    results = [False] * len(items)
+    METRICS.ensure(config)
+    _configure_caches(config)
+    try:
+        with METRICS.image(*(input_path for input_path, _ in items)) as record:
+            results = ENGINES[engine].apply_watermark_batch(temp_items, watermark_path, config)
+            record.success = all(results)
+        for index, ((_, temp_path), (_, output_path)) in enumerate(zip(temp_items, items)):
+            if results[index]:
+                os.replace(temp_path, output_path)
+        METRICS.record_caches(WatermarkCreator.cache_info())
+        return [(fingerprint or success) if success else False
+                for fingerprint, success in zip(fingerprints, results)]
+    finally:
+        for success, (_, temp_path) in zip(results, temp_items):
+            if not success and os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+class BatchExecutor:
+    """Параллельная обработка пакета изображений"""
+    DEFAULT_TIMEOUT = 300
+    # Сколько изображений одного размера отдавать одному процессу ffmpeg
+    DEFAULT_BATCH_SIZE = 16
+
+    def __init__(self, engine, workers=None, max_in_flight=None, timeout=DEFAULT_TIMEOUT,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self.engine = engine
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.max_in_flight = max_in_flight or self.workers * 2
+        self.timeout = timeout
+        # Группировка имеет смысл только для движков с пакетным режимом
+        self.batch_size = batch_size if hasattr(ENGINES[engine], 'apply_watermark_batch') else 1
+        self._pool = None
+
+    @property
+    def processes(self):
+        """Сколько процессов держат собственные кэши водяного знака"""
+        return 1 if self.engine == 'ffmpeg' else self.workers
+
+    def _get_pool(self):
+        """Процессы для встроенного движка, потоки для параллельных вызовов ffmpeg.
+
+        Пул живет между вызовами run(), поэтому рабочие процессы сохраняют свои кэши.
+        """
+        if self._pool is None:
+            if self.engine == 'ffmpeg':
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        return self._pool
+
+    def close(self):
+        """Останавливает пул"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _group(self, jobs):
+        """Объединяет идущие подряд задачи с одинаковым разрешением в группы"""
+        group, group_size = [], None
+        for job in jobs:
+            size = METADATA_INDEX.dimensions(job[1]) if self.batch_size > 1 else None
+            if group and (size != group_size or size == (None, None)
+                          or len(group) >= self.batch_size):
+                yield group
+                group = []
+            group.append(job)
+            group_size = size
+        if group:
+            yield group
+
+    def run(self, jobs, watermark_path, config, cancel_event=None):
+        """Выполняет задачи (name, input_path, output_path) и выдает (name, результат) по мере готовности.
+
+        Результат — False при ошибке, иначе True или отпечаток входного файла при config['fingerprint'].
+        """
+        config = dict(config, timeout=self.timeout)
+        cancelled = cancel_event.is_set if cancel_event is not None else (lambda: False)
+
+        if self.workers == 1:
+            # Без пула: нет затрат на запуск процессов и передачу данных
+            for group in self._group(jobs):
+                if cancelled():
+                    return
+                yield from self._run_inline(group, watermark_path, config)
+            return
+
+        pool = self._get_pool()
+        in_flight = {}
+        for group in self._group(jobs):
+            if cancelled():
+                # Новые задачи не отправляем, начатые дожидаемся ниже
+                break
+            # Ограничиваем количество одновременно выполняемых задач
+            while len(in_flight) >= self.max_in_flight:
+                yield from self._collect(in_flight, FIRST_COMPLETED)
+            future = pool.submit(_process_group, self.engine,
+                                 [(input_path, output_path) for _, input_path, output_path in group],
+                                 watermark_path, config)
+            in_flight[future] = [name for name, _, _ in group]
+        while in_flight:
+            yield from self._collect(in_flight, FIRST_COMPLETED)
+
+    def _run_inline(self, group, watermark_path, config):
+        try:
+            results = _process_group(self.engine,
+                                     [(input_path, output_path) for _, input_path, output_path in group],
+                                     watermark_path, config)
+        except Exception as e:
+            print(f"Ошибка при обработке {group[0][1]}: {e}")
+            results = [False] * len(group)
+        for (name, _, _), success in zip(group, results):
+            yield name, success
+
+    @staticmethod
+    def _collect(in_flight, return_when):
+        done, _ = wait(in_flight, return_when=return_when)
+        for future in done:
+            names = in_flight.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"Ошибка при обработке {', '.join(names)}: {e}")
+                results = [False] * len(names)
+            for name, success in zip(names, results):
+                yield name, success
+
+class StagePipeline:
+    """Конвейер чтение → декодирование → наложение → кодирование/запись для движка Pillow.
+
+    Стадии связаны ограниченными очередями и работают одновременно, поэтому
+    ввод-вывод одного файла перекрывается с обработкой других. Декодированные кадры
+    ограничены объемом памяти, а не числом мест в очередях: большие кадры ждут перед
+    декодированием, пока не освободится место.
+    """
+    STAGES = ('read', 'decode', 'composite', 'write')
+    STAGE_LABELS = {
+        'read': 'чтение',
+        'decode': 'декодирование',
+        'composite': 'наложение',
+        'write': 'запись',
+    }
+    _STOP = object()
+    # Все стадии — потоки одного процесса с общими кэшами
+    processes = 1
+    # Сколько памяти могут занимать декодированные кадры и результаты в работе
+    FRAME_BUDGET = 512 * 1024 * 1024
+
+    def __init__(self, stage_workers=None, queue_size=None, frame_budget=None):
+        cpus = os.cpu_count() or 1
+        self.stage_workers = {'read': 4, 'decode': cpus, 'composite': cpus, 'write': cpus}
+        self.stage_workers.update(stage_workers or {})
+        self.frame_budget = frame_budget or self.FRAME_BUDGET
+        self._frame_bytes = 0
+        self._frames = threading.Condition()
+        # Очередь перед стадией вмещает по две задачи на каждый ее поток
+        self.queue_size = queue_size or {
+            stage: self.stage_workers[stage] * 2 for stage in self.STAGES
+        }
+        self._queues = {}
+        self._threads = []
+        self._results = None
+
+    @staticmethod
+    def parse_workers(value):
+        """Потоки стадий из строки вида «decode=8,write=4»; пустая строка — значения по умолчанию"""
+        workers = {}
+        for part in filter(None, (part.strip() for part in (value or '').split(','))):
+            stage, _, count = (item.strip() for item in part.partition('='))
+            if stage not in StagePipeline.STAGES or not count.isdigit() or int(count) < 1:
+                raise ValueError("Потоки стадий задаются как стадия=число через запятую, стадии: "
+                                 + ', '.join(StagePipeline.STAGES))
+            workers[stage] = int(count)
+        return workers or None
+
+    def queue_depths(self):
+        """Текущая глубина очереди перед каждой стадией"""
+        return {stage: q.qsize() for stage, q in self._queues.items()}
+
+    def describe_queues(self):
+        """Глубины очередей в виде строки для статуса"""
+        return ', '.join(f"{self.STAGE_LABELS[stage]} {depth}"
+                         for stage, depth in self.queue_depths().items())
+
+    def run(self, jobs, watermark_path, config, cancel_event=None):
+        """Выполняет задачи (name, input_path, output_path) и выдает (name, результат) по мере готовности.
+
+        Результат такой же, как у BatchExecutor.run.
+        """
+        cancelled = cancel_event.is_set if cancel_event is not None else (lambda: False)
+        self._start(watermark_path, config)
+        # Задач в работе не больше, чем вмещают очереди и потоки всех стадий:
+        # дальше давление создают сами ограниченные очереди
+        max_in_flight = sum(self.queue_size.values()) + sum(self.stage_workers.values())
+        in_flight = 0
+        try:
+            for name, input_path, output_path in jobs:
+                if cancelled():
+                    break
+                while in_flight >= max_in_flight:
+                    yield self._results.get()
+                    in_flight -= 1
+                self._queues['read'].put((name, {'input_path': input_path,
+                                                 'output_path': output_path}))
+                in_flight += 1
+
+                # Отдаем уже готовые результаты, не дожидаясь заполнения очереди
+                while in_flight:
+                    try:
+                        result = self._results.get_nowait()
+                    except queue.Empty:
+                        break
+                    in_flight -= 1
+                    yield result
+
+            while in_flight:
+                yield self._results.get()
+                in_flight -= 1
+        finally:
+            self._stop()
+
+    def close(self):
+        """Потоки стадий останавливаются в конце каждого run(), держать нечего"""
+
+    def _start(self, watermark_path, config):
+        watermark = PillowHandler._load_watermark(watermark_path)
+        handlers = {
+            'read': lambda job: self._read(job, config.get('fingerprint')),
+            'decode': self._decode,
+            'composite': lambda job: self._composite(job, watermark, watermark_path, config),
+            'write': self._write,
+        }
+        self._queues = {stage: queue.Queue(maxsize=self.queue_size[stage]) for stage in self.STAGES}
+        self._results = queue.Queue()
+        self._threads = []
+        for index, stage in enumerate(self.STAGES):
+            next_queue = self._queues[self.STAGES[index + 1]] if index + 1 < len(self.STAGES) else None
+            for _ in range(self.stage_workers[stage]):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage, self._queues[stage], next_queue, handlers[stage]),
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _stop(self):
+        # Очереди пусты: все задачи завершены, останавливаем потоки по порядку стадий
+        for stage in self.STAGES:
+            for _ in range(self.stage_workers[stage]):
+                self._queues[stage].put(self._STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _worker(self, stage, in_queue, out_queue, handler):
+        while True:
+            item = in_queue.get()
+            if item is self._STOP:
+                return
+            name, job = item
+            start = time.perf_counter()
+            try:
+                job = handler(job)
+            except Exception as e:
+                print(f"Ошибка при обработке {name}: {e}")
+                self._release_frame(job)
+                self._record(job, stage, start, False)
+                self._results.put((name, False))
+                continue
+            if out_queue is not None:
+                self._record(job, stage, start)
+                out_queue.put((name, job))
+            else:
+                self._release_frame(job)
+                self._record(job, stage, start, True)
+                self._results.put((name, job.get('fingerprint', True)))
+
+    def _acquire_frame(self, job, size):
+        """Ждет, пока в бюджете кадров хватит места для кадра size.
+
+        Кадр больше всего бюджета пропускается, когда других кадров в работе нет.
+        """
+        # Декодированный кадр и результат в выходном режиме, до 4 байт на пиксель каждый
+        frame_bytes = size[0] * size[1] * 8
+        with self._frames:
+            while self._frame_bytes and self._frame_bytes + frame_bytes > self.frame_budget:
+                self._frames.wait()
+            self._frame_bytes += frame_bytes
+        job['frame_bytes'] = frame_bytes
+
+    def _release_frame(self, job):
+        frame_bytes = job.pop('frame_bytes', 0)
+        if frame_bytes:
+            with self._frames:
+                self._frame_bytes -= frame_bytes
+                self._frames.notify_all()
+
+    @staticmethod
+    def _record(job, stage, start, success=None):
+        """Копит время стадий в задаче; по завершении пишет строку журнала метрик"""
+        if not METRICS.enabled:
+            return
+        stages = job.setdefault('stages', {})
+        stages[stage] = time.perf_counter() - start
+        if success is not None:
+            METRICS.record_image([job['input_path']], stages, job.get('bytes_read', 0),
+                                 job.get('bytes_written', 0), success, sum(stages.values()))
+
+    @staticmethod
+    def _read(job, fingerprint=False):
+        with open(job['input_path'], 'rb') as f:
+            job['data'] = f.read()
+        job['bytes_read'] = len(job['data'])
+        if fingerprint:
+            # Файл уже в памяти: отпечаток для манифеста без повторного чтения
+            job['fingerprint'] = ProcessingManifest.fingerprint_data(job['data'])
+        return job
+
+    def _decode(self, job):
+        image = Image.open(io.BytesIO(job.pop('data')))
+        # Размер известен из заголовка, память под кадр занимаем до декодирования
+        self._acquire_frame(job, image.size)
+        image.load()
+        job['image'] = image
+        return job
+
+    @staticmethod
+    def _composite(job, watermark, watermark_path, config):
+        job['result'], job['mode'] = PillowHandler.render(job.pop('image'), watermark,
+                                                          watermark_path, config, job['output_path'],
+                                                          in_place=True)
+        return job
+
+    @staticmethod
+    def _write(job):
+        # Запись через временный файл, как и в _process_job
+        output_path = job['output_path']
+        temp_path = _temp_output_path(output_path)
+        try:
+            PillowHandler._save(job.pop('result'), temp_path, job['mode'])
+            job['bytes_written'] = os.path.getsize(temp_path)
+            os.replace(temp_path, output_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        return job
 
 class WatermarkCreator:
     """Класс для создания водяного знака"""
-    def __init__(self, text, font_path, font_size, color, angle):
+    RENDER_CACHE_SIZE = 16
+    # Отрисованные водяные знаки: ключ настроек -> изображение
+    _render_cache = OrderedDict()
+    _render_hits = 0
+    _render_misses = 0
+    # Временный файл -> изображение, чтобы движок Pillow не декодировал его заново
+    _rendered_files = {}
+    _lock = threading.Lock()
+
+    def __init__(self, text, font_path, font_size, color, angle, font_index=0):
         self.text = text
         self.font_path = font_path
+        self.font_index = font_index
         self.font_size = font_size
         self.color = color
         self.angle = angle
         self._temp_file = None
 
-    def create(self):
-        """Создает изображение водяного знака"""
-        try:
-            # Создаем базовое изображение
-            img = Image.new('RGBA', (1024, 1024), (255, 255, 255, 0))
-            draw = ImageDraw.Draw(img)
-
-            # Загружаем шрифт
-            try:
-                font = ImageFont.truetype(self.font_path, self.font_size)
-            except Exception as e:
-                print(f"Ошибка загрузки шрифта: {e}")
-                font = ImageFont.load_default()
+    @property
+    def key(self):
+        """Ключ настроек, от которых зависит изображение водяного знака"""
+        return (self.text, self.font_path, self.font_index, self.font_size, self.color, self.angle)
+
+    def render(self):
+        """Возвращает изображение водяного знака, отрисовывая его только при первом запросе"""
+        cls = WatermarkCreator
+        with cls._lock:
+            img = cls._render_cache.get(self.key)
+            if img is not None:
+                cls._render_cache.move_to_end(self.key)
+                cls._render_hits += 1
+                return img
+            cls._render_misses += 1
+
+        img = self._draw()
+        with cls._lock:
+            cls._render_cache[self.key] = img
+            while len(cls._render_cache) > cls.RENDER_CACHE_SIZE:
+                cls._render_cache.popitem(last=False)
+        return img
+
+    def _draw(self):
+        """Отрисовывает текст и поворачивает его"""
+        font = WatermarkCreator._load_font(self.font_path, self.font_size, self.font_index)
+
+        # Получаем размеры текста (холст для измерения не нужен)
+        bbox = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), self.text, font=font)
+        text_width = bbox[2] - bbox[0]
+        text_height = bbox[3] - bbox[1]
+
+        # Создаем изображение нужного размера
+        img = Image.new('RGBA', (text_width + 50, text_height + 50), (255, 255, 255, 0))
+        draw = ImageDraw.Draw(img)
+
+        # Рисуем текст
+        draw.text((25, 25), self.text, font=font, fill=self.color)
+
+        # Поворачиваем если нужно
+        if self.angle != 0:
+            img = img.rotate(self.angle, expand=True, fillcolor=(255, 255, 255, 0))
+        return img
 
-            # Получаем размеры текста
-            bbox = draw.textbbox((0, 0), self.text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-
-            # Создаем изображение нужного размера
-            img = Image.new('RGBA', (text_width + 50, text_height + 50), (255, 255, 255, 0))
-            draw = ImageDraw.Draw(img)
-
-            # Рисуем текст
-            draw.text((25, 25), self.text, font=font, fill=self.color)
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _load_font(font_path, font_size, font_index=0):
+        """Загружает шрифт один раз для каждого размера"""
+        try:
+            return ImageFont.truetype(font_path, font_size, index=font_index)
+        except Exception as e:
+            print(f"Ошибка загрузки шрифта: {e}")
+            return ImageFont.load_default()
 
-            # Поворачиваем если нужно
-            if self.angle != 0:
-                img = img.rotate(self.angle, expand=True, fillcolor=(255, 255, 255, 0))
+    def create(self):
+        """Создает изображение водяного знака и возвращает путь к PNG (нужен для ffmpeg)"""
+        try:
+            with METRICS.stage('watermark_render'):
+                img = self.render()
 
             # Сохраняем во временный файл
-            self._temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-            img.save(self._temp_file.name, 'PNG')
+            with METRICS.stage('watermark_write'):
+                self._temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
+                self._temp_file.close()
+                img.save(self._temp_file.name, 'PNG')
+            with WatermarkCreator._lock:
+                WatermarkCreator._rendered_files[self._temp_file.name] = img
             return self._temp_file.name
 
         except Exception as e:
             print(f"Ошибка создания водяного знака: {e}")
             return None
 
+    @staticmethod
+    def rendered(path):
+        """Изображение, сохраненное этим процессом в path, или None"""
+        with WatermarkCreator._lock:
+            return WatermarkCreator._rendered_files.get(path)
+
+    @staticmethod
+    def cache_info():
+        """Статистика кэшей водяного знака: отрисовка, масштабированные варианты и слои"""
+        with WatermarkCreator._lock:
+            total = WatermarkCreator._render_hits + WatermarkCreator._render_misses
+            render = {
+                'hits': WatermarkCreator._render_hits,
+                'misses': WatermarkCreator._render_misses,
+                'hit_rate': WatermarkCreator._render_hits / total if total else 0.0,
+                'entries': len(WatermarkCreator._render_cache),
+            }
+        return {'render': render, 'scaled': SCALED_CACHE.stats(), 'layers': LAYER_CACHE.stats()}
+
+    @staticmethod
+    def reset_cache_info():
+        """Обнуляет счетчики всех кэшей водяного знака текущего процесса"""
+        with WatermarkCreator._lock:
+            WatermarkCreator._render_hits = WatermarkCreator._render_misses = 0
+        SCALED_CACHE.reset_stats()
+        LAYER_CACHE.reset_stats()
+
     def cleanup(self):
         """Удаляет временный файл"""
+        if self._temp_file:
+            with WatermarkCreator._lock:
+                WatermarkCreator._rendered_files.pop(self._temp_file.name, None)
         if self._temp_file and os.path.exists(self._temp_file.name):
             try:
                 os.unlink(self._temp_file.name)
             except Exception as e:
                 print(f"Ошибка удаления временного файла: {e}")
 
-class FontManager:
-    """Класс для управления шрифтами"""
-    DEFAULT_FONT = "Montserrat-Black"  # Устанавливаем шрифт по умолчанию здесь
-    
+class FontIndex:
+    """Постоянный индекс шрифтов: имя -> (файл, номер начертания в .ttc)"""
+    VERSION = 1
+    FONT_EXTENSIONS = ('.ttf', '.ttc', '.otf')
+
+    def __init__(self, index_path=None):
+        self.index_path = index_path
+        self._fonts = None
+        self._lock = threading.Lock()
+
     @staticmethod
-    def get_system_fonts():
-        """Получает список доступных системных шрифтов, с Montserrat Black в начале списка"""
-        fonts = []
+    def font_dirs():
+        """Стандартные папки шрифтов для текущей системы"""
         if sys.platform == "darwin":
-            font_dirs = [
+            dirs = [
                 "/Library/Fonts",
                 "/System/Library/Fonts",
+                "/System/Library/Fonts/Supplemental",
                 os.path.expanduser("~/Library/Fonts")
             ]
-            for font_dir in font_dirs:
-                if os.path.exists(font_dir):
-                    fonts.extend([os.path.splitext(f)[0] for f in os.listdir(font_dir)
-                                if f.endswith(('.ttf', '.ttc'))])
-                    
-        fonts = sorted(list(set(fonts)))  # Удаляем дубликаты и сортируем
-        
+        else:
+            dirs = [
+                "/usr/share/fonts",
+                "/usr/local/share/fonts",
+                os.path.expanduser("~/.local/share/fonts"),
+                os.path.expanduser("~/.fonts")
+            ]
+        return [d for d in dirs if os.path.isdir(d)]
+
+    def fonts(self):
+        """Словарь имя -> {'path', 'index'}; строится один раз и берется с диска"""
+        with self._lock:
+            if self._fonts is None:
+                self._fonts = self._load() or self._build()
+            return self._fonts
+
+    def lookup(self, font_name):
+        """Возвращает (путь, номер начертания) или (None, 0)"""
+        entry = self.fonts().get(font_name)
+        if entry is None:
+            return None, 0
+        return entry['path'], entry['index']
+
+    def _load(self):
+        if self.index_path is None:
+            self.index_path = os.path.join(_cache_dir(), 'font_index.json')
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ошибка чтения индекса шрифтов: {e}")
+            return None
+
+        # Индекс устарел, если изменилась любая из просканированных папок
+        if data.get('version') != self.VERSION or \
+                set(data['roots']) != set(self.font_dirs()) or \
+                any(self._mtime(d) != mtime for d, mtime in data['dirs'].items()):
+            return None
+        return data['fonts']
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _build(self):
+        """Сканирует папки шрифтов и сохраняет индекс"""
+        fonts = {}
+        dirs = {}
+        roots = self.font_dirs()
+        for root in roots:
+            for directory, _, files in os.walk(root):
+                dirs[directory] = self._mtime(directory)
+                for name in sorted(files):
+                    if name.lower().endswith(self.FONT_EXTENSIONS):
+                        self._add_file(fonts, os.path.join(directory, name))
+
+        try:
+            _write_json_atomic(self.index_path, {
+                'version': self.VERSION, 'roots': roots, 'dirs': dirs, 'fonts': fonts
+            })
+        except Exception as e:
+            print(f"Ошибка сохранения индекса шрифтов: {e}")
+        return fonts
+
+    @staticmethod
+    def _add_file(fonts, path):
+        """Добавляет имя файла и имена всех начертаний (.ttc содержит несколько)"""
+        stem = os.path.splitext(os.path.basename(path))[0]
+        fonts.setdefault(stem, {'path': path, 'index': 0})
+
+        index = 0
+        while True:
+            try:
+                font = ImageFont.truetype(path, 10, index=index)
+            except Exception:
+                break
+            family, style = font.getname()
+            if family:
+                name = f"{family} {style}" if style and style != 'Regular' else family
+                fonts.setdefault(name, {'path': path, 'index': index})
+            if not path.lower().endswith('.ttc'):
+                break
+            index += 1
+
+class FontManager:
+    """Класс для управления шрифтами"""
+    DEFAULT_FONT = "Montserrat-Black"  # Устанавливаем шрифт по умолчанию здесь
+    # Запасные шрифты, если запрошенный не найден
+    FALLBACK_FONTS = ("Helvetica", "DejaVuSans", "DejaVu Sans", "LiberationSans-Regular")
+
+    @staticmethod
+    def get_system_fonts():
+        """Получает список доступных системных шрифтов, с Montserrat Black в начале списка"""
+        fonts = sorted(FONT_INDEX.fonts())
+
         # Перемещаем Montserrat Black в начало списка, если он есть
         if FontManager.DEFAULT_FONT in fonts:
             fonts.remove(FontManager.DEFAULT_FONT)
             fonts.insert(0, FontManager.DEFAULT_FONT)
-            
+
         return fonts
 
+    @staticmethod
+    def get_font(font_name):
+        """Получает путь к файлу шрифта и номер начертания внутри .ttc"""
+        path, index = FONT_INDEX.lookup(font_name)
+        if path is not None:
+            return path, index
+
+        # Возвращаем запасной шрифт
+        for fallback in FontManager.FALLBACK_FONTS:
+            path, index = FONT_INDEX.lookup(fallback)
+            if path is not None:
+                return path, index
+        return None, 0
+
     @staticmethod
     def get_font_path(font_name):
         """Получает путь к файлу шрифта"""
-        if sys.platform == "darwin":
-            # Проверяем, запрашивается ли шрифт по умолчанию
-            if font_name == FontManager.DEFAULT_FONT:
-                montserrat_paths = [
-                    "/Library/Fonts/Montserrat-Black.ttf",
-                    os.path.expanduser("~/Library/Fonts/Montserrat-Black.ttf"),
-                    os.path.expanduser("/System/Library/Fonts/Montserrat-Black.ttf")
-                ]
-                for path in montserrat_paths:
-                    if os.path.exists(path):
-                        return path
-            
-            # Поиск в стандартных директориях
-            font_dirs = [
-                "/Library/Fonts",
-                "/System/Library/Fonts",
-                os.path.expanduser("~/Library/Fonts")
-            ]
-            for font_dir in font_dirs:
-                for ext in ['.ttf', '.ttc']:
-                    path = os.path.join(font_dir, f"{font_name}{ext}")
-                    if os.path.exists(path):
-                        return path
-            
-            # Возвращаем путь к Helvetica как запасной вариант
-            return "/System/Library/Fonts/Helvetica.ttc"
+        return FontManager.get_font(font_name)[0]
+
+# Общий индекс шрифтов для текущего процесса
+FONT_INDEX = FontIndex()
+
+def shard_of(rel_path, count):
+    """Номер шарда для относительного пути; одинаков на любой машине и ОС"""
+    key = rel_path.replace(os.sep, '/').encode('utf-8')
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+class ProcessingManifest:
+    """Манифест выходной папки: что уже обработано и с какими настройками"""
+    FILENAME = '.watermark_manifest.json'
+    VERSION = 1
+    # Поля настроек, от которых зависит результат
+    CONFIG_FIELDS = ('text', 'font_name', 'font_size', 'color', 'angle',
+                     'opacity', 'tile_enabled', 'density')
+    SAVE_EVERY = 100
+
+    def __init__(self, output_folder, settings, shard=None):
+        self.path = self.path_for(output_folder, shard)
+        self.output_folder = output_folder
+        self.config_hash = self.hash_config(settings)
+        self.shard = shard
+        self.complete = False
+        self._entries = {}
+        self._failed = {}
+        # Входные файлы, пройденные в этом запуске
+        self._seen = set()
+        self._unsaved = 0
+        if not self._load(self.path) and shard is not None:
+            # Первый запуск шарда: берем его часть из общего манифеста после прошлого слияния
+            if self._load(self.path_for(output_folder)):
+                self._entries = {name: entry for name, entry in self._entries.items()
+                                 if shard_of(name, shard[1]) == shard[0]}
+                self._failed = {}
+
+    @staticmethod
+    def path_for(output_folder, shard=None):
+        """Путь общего манифеста или частичного манифеста шарда"""
+        if shard is None:
+            return os.path.join(output_folder, ProcessingManifest.FILENAME)
+        index, count = shard
+        name = ProcessingManifest.FILENAME.replace('.json', f'.shard-{index}-of-{count}.json')
+        return os.path.join(output_folder, name)
+
+    @staticmethod
+    def hash_config(settings):
+        """Хэш эффективной конфигурации водяного знака"""
+        effective = {field: settings[field] for field in ProcessingManifest.CONFIG_FIELDS}
+        if settings.get('variants'):
+            effective['variants'] = settings['variants']
+        data = json.dumps(effective, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fingerprint(path):
+        """Отпечаток содержимого файла"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def fingerprint_data(data):
+        """Отпечаток уже прочитанного содержимого, совпадает с fingerprint(path)"""
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    @staticmethod
+    def read(path):
+        """Содержимое файла манифеста или None, если его нет или он другой версии"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ошибка чтения манифеста {path}: {e}")
+            return None
+        return data if data.get('version') == ProcessingManifest.VERSION else None
+
+    def _load(self, path):
+        data = self.read(path)
+        if data is None:
+            return False
+        self._entries = data['entries']
+        self._failed = data.get('failed', {})
+        return True
+
+    def check(self, name, input_path, output_path):
+        """Возвращает (актуален ли результат, состояние входного файла для record).
+
+        Отпечаток в состоянии равен None, если файл будет обработан в любом случае:
+        его считает рабочий процесс вместе с обработкой, а не диспетчер по одному файлу.
+        """
+        self._seen.add(name)
+        stat = os.stat(input_path)
+        entry = self._entries.get(name)
+        reusable = (
+            entry is not None
+            and entry['config_hash'] == self.config_hash
+            and entry['output'] == os.path.relpath(output_path, self.output_folder)
+            and os.path.exists(output_path)
+        )
+
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            fingerprint = entry['fingerprint']
+        elif reusable:
+            # Файл мог измениться: только отпечаток покажет, нужна ли обработка
+            fingerprint = self.fingerprint(input_path)
+        else:
+            fingerprint = None
+
+        state = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'fingerprint': fingerprint}
+        current = reusable and entry['fingerprint'] == fingerprint
+        if current and entry['mtime'] != stat.st_mtime_ns:
+            # Содержимое не изменилось, обновляем только время
+            self.record(name, output_path, state)
+        return current, state
+
+    def record(self, name, output_path, state):
+        """Отмечает входной файл как обработанный"""
+        self._entries[name] = dict(
+            state,
+            config_hash=self.config_hash,
+            output=os.path.relpath(output_path, self.output_folder),
+        )
+        self._failed.pop(name, None)
+        self._changed()
+
+    def record_failure(self, name, error=None):
+        """Отмечает входной файл, который не удалось обработать"""
+        self._seen.add(name)
+        self._entries.pop(name, None)
+        self._failed[name] = error or "ошибка обработки"
+        self._changed()
+
+    def mark_complete(self):
+        """Отмечает, что все файлы шарда пройдены, и забывает входные файлы, которых больше нет"""
+        for names in (self._entries, self._failed):
+            for name in [name for name in names if name not in self._seen]:
+                del names[name]
+        self.complete = True
+        self._changed()
+
+    def _changed(self):
+        self._unsaved += 1
+        if self._unsaved >= self.SAVE_EVERY:
+            self.save()
+
+    def save(self):
+        """Атомарно сохраняет манифест"""
+        if not self._unsaved:
+            return
+        data = {'version': self.VERSION, 'config_hash': self.config_hash,
+                'entries': self._entries, 'failed': self._failed}
+        if self.shard is not None:
+            data['shard'] = list(self.shard)
+            data['complete'] = self.complete
+        try:
+            _write_json_atomic(self.path, data)
+            self._unsaved = 0
+        except Exception as e:
+            print(f"Ошибка сохранения манифеста: {e}")
+
+    @staticmethod
+    def merge(input_folder, output_folder, count):
+        """Сливает частичные манифесты шардов в общий и проверяет покрытие входной папки.
+
+        Возвращает словарь с отсутствующими, необработанными и незавершенными шардами.
+        """
+        entries = {}
+        failed = {}
+        config_hashes = set()
+        missing_shards = []
+        incomplete_shards = []
+        for index in range(count):
+            data = ProcessingManifest.read(ProcessingManifest.path_for(output_folder, (index, count)))
+            if data is None:
+                missing_shards.append(index)
+                continue
+            if not data.get('complete'):
+                incomplete_shards.append(index)
+            config_hashes.add(data.get('config_hash'))
+            entries.update(data['entries'])
+            failed.update(data.get('failed', {}))
+
+        if len(config_hashes) > 1:
+            raise Exception("Шарды обработаны с разными настройками водяного знака")
+
+        # Каждое изображение входной папки должно иметь результат на диске;
+        # записи об удаленных с тех пор файлах не учитываются
+        scanned = set(ImageScanner(input_folder, exclude=[output_folder],
+                                   videos=FFmpegHandler.check_ffmpeg()))
+        entries = {name: entry for name, entry in entries.items() if name in scanned}
+        failed = {name: error for name, error in failed.items() if name in scanned}
+        missing = []
+        for rel_path in scanned:
+            entry = entries.get(rel_path)
+            if rel_path in failed:
+                continue
+            if entry is None or not os.path.exists(os.path.join(output_folder, entry['output'])):
+                missing.append(rel_path)
+
+        if config_hashes:
+            _write_json_atomic(ProcessingManifest.path_for(output_folder), {
+                'version': ProcessingManifest.VERSION, 'config_hash': config_hashes.pop(),
+                'entries': entries, 'failed': failed,
+            })
+        return {
+            'processed': len(entries),
+            'missing': sorted(missing),
+            'failed': dict(sorted(failed.items())),
+            'missing_shards': missing_shards,
+            'incomplete_shards': incomplete_shards,
+        }
+
+class ImageScanner:
+    """Ленивый рекурсивный поиск изображений и видео во входной папке"""
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
+    VIDEO_EXTENSIONS = ('.mp4', '.mov')
+
+    def __init__(self, root, exclude=(), recursive=True, shard=None, videos=True):
+        self.root = root
+        self.recursive = recursive
+        # Видео обрабатываются только через ffmpeg; без него их не выдаем
+        self.videos = videos
+        # (номер, количество): выдавать только пути, попавшие в этот шард
+        self.shard = shard
+        # Выходная папка часто лежит внутри входной, ее не сканируем
+        self.exclude = {os.path.realpath(path) for path in exclude}
+        self.total = None
+        self._count_thread = None
+
+    def __iter__(self):
+        """Выдает относительные пути изображений по мере обхода каталогов"""
+        pending = ['']
+        while pending:
+            rel_dir = pending.pop()
+            directory = os.path.join(self.root, rel_dir)
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        rel_path = os.path.join(rel_dir, entry.name)
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.recursive and os.path.realpath(entry.path) not in self.exclude:
+                                pending.append(rel_path)
+                        elif self.is_media(entry.name, self.videos) and self._in_shard(rel_path):
+                            yield rel_path
+            except OSError as e:
+                print(f"Ошибка чтения папки {directory}: {e}")
+
+    def _in_shard(self, rel_path):
+        return self.shard is None or shard_of(rel_path, self.shard[1]) == self.shard[0]
+
+    @staticmethod
+    def is_image(name):
+        """Подходит ли файл для обработки (временные файлы пропускаются)"""
+        return name.lower().endswith(ImageScanner.IMAGE_EXTENSIONS) and not name.startswith('.tmp-')
+
+    @staticmethod
+    def is_video(name):
+        """Видео, которое обрабатывается через ffmpeg"""
+        return name.lower().endswith(ImageScanner.VIDEO_EXTENSIONS) and not name.startswith('.tmp-')
+
+    @staticmethod
+    def is_media(name, videos=True):
+        return ImageScanner.is_image(name) or (videos and ImageScanner.is_video(name))
+
+    def count_async(self):
+        """Подсчитывает общее количество в отдельном потоке, чтобы не задерживать обработку"""
+        def count():
+            self.total = sum(1 for _ in self)
+
+        self._count_thread = threading.Thread(target=count, daemon=True)
+        self._count_thread.start()
+        return self._count_thread
+
+class OutputVariants:
+    """Спецификация выходных вариантов: размеры, форматы, качество и водяные знаки.
+
+    Файл спецификации — JSON-список вариантов, например:
+        [{"name": "full", "format": "jpeg", "quality": 92},
+         {"name": "web", "max_size": 2048, "format": "webp", "quality": 80},
+         {"name": "partner", "max_size": 2048, "watermark": {"text": "@partner"}}]
+    Каждый вариант пишется в свою подпапку выходной папки.
+    """
+    FORMATS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+    # Поля водяного знака, которые вариант может переопределить
+    WATERMARK_FIELDS = ProcessingManifest.CONFIG_FIELDS
+
+    @staticmethod
+    def load(path):
+        """Читает и проверяет файл спецификации"""
+        with open(path, encoding='utf-8') as f:
+            spec = json.load(f)
+        OutputVariants.validate(spec)
+        return spec
+
+    @staticmethod
+    def validate(spec):
+        if not isinstance(spec, list) or not spec:
+            raise Exception("Спецификация вариантов должна быть непустым списком")
+        names = set()
+        for variant in spec:
+            name = variant.get('name')
+            if not name or not isinstance(name, str) or os.sep in name or name.startswith('.'):
+                raise Exception(f"Некорректное имя варианта: {name!r}")
+            if name in names:
+                raise Exception(f"Повторяющееся имя варианта: {name}")
+            names.add(name)
+            if variant.get('format') is not None and variant['format'] not in OutputVariants.FORMATS:
+                raise Exception(f"Вариант {name}: формат должен быть одним из "
+                                f"{', '.join(OutputVariants.FORMATS)}")
+            quality = variant.get('quality')
+            if quality is not None and not (isinstance(quality, int) and 1 <= quality <= 100):
+                raise Exception(f"Вариант {name}: качество должно быть от 1 до 100")
+            max_size = variant.get('max_size')
+            if max_size is not None and not (isinstance(max_size, int) and max_size > 0):
+                raise Exception(f"Вариант {name}: max_size должен быть положительным числом")
+            unknown = set(variant.get('watermark', {})) - set(OutputVariants.WATERMARK_FIELDS)
+            if unknown:
+                raise Exception(f"Вариант {name}: неизвестные поля водяного знака: "
+                                f"{', '.join(sorted(unknown))}")
+
+    @staticmethod
+    def resolve(spec, settings, watermark_for):
+        """Варианты для движка: папка, расширение и готовый водяной знак каждого.
+
+        watermark_for(settings) возвращает путь к водяному знаку для настроек варианта.
+        """
+        variants = []
+        for variant in spec:
+            effective = dict(settings, **variant.get('watermark', {}))
+            try:
+                WatermarkBatch.validate(effective)
+            except ValueError as e:
+                raise Exception(f"Вариант {variant['name']}: {e}")
+            variants.append({
+                'name': variant['name'],
+                'dir': os.path.join(settings['output_folder'], variant['name']),
+                'ext': OutputVariants.FORMATS.get(variant.get('format')),
+                'quality': variant.get('quality'),
+                'max_size': variant.get('max_size'),
+                'watermark_path': watermark_for(effective),
+                'config': {field: effective[field]
+                           for field in ('opacity', 'tile_enabled', 'density')},
+            })
+        return variants
+
+    @staticmethod
+    def outputs(input_path, output_path, variants):
+        """Пути всех вариантов по пути первого из них"""
+        rel_root = os.path.splitext(os.path.relpath(output_path, variants[0]['dir']))[0]
+        source_ext = os.path.splitext(input_path)[1]
+        return [os.path.join(variant['dir'], rel_root + (variant['ext'] or source_ext))
+                for variant in variants]
+
+class WatermarkBatch:
+    """Пакетная обработка папки с изображениями без привязки к интерфейсу"""
+    # Сколько найденных файлов группировать по разрешению перед отправкой в работу
+    CHUNK_SIZE = 256
+    # Общий бюджет кэшей водяного знака на все рабочие процессы
+    CACHE_BUDGET = 1024 * 1024 * 1024
+
+    def __init__(self, settings, report=None, cancel_event=None):
+        self.settings = settings
+        self.report = report or (lambda processed, total, message: None)
+        self.cancel_event = cancel_event or threading.Event()
+        self.processed = 0
+        self.skipped = 0
+        self.discovered = 0
+        self._counter = None
+        self._creator = None
+        self._variant_creators = {}
+        self.videos = False
+        self.watermark_path = None
+        self.variants = None
+        self.manifest = None
+        self.executor = None
+
+    def config(self):
+        """Конфигурация наложения для движков"""
+        return {
+            'opacity': self.settings['opacity'],
+            'tile_enabled': self.settings['tile_enabled'],
+            'density': self.settings['density'],
+            'memory_budget': self.settings.get('memory_budget'),
+            'cache_budget': self.cache_budget(),
+            # Отпечатки новых файлов для манифеста считают рабочие процессы
+            'fingerprint': True,
+            'metrics_log': self.settings.get('metrics_log'),
+            'variants': self.variants,
+        }
+
+    @staticmethod
+    def validate(settings):
+        """Проверяет диапазоны настроек (общая проверка интерфейса и командной строки)"""
+        if not 0 <= settings['opacity'] <= 1:
+            raise ValueError("Прозрачность должна быть от 0 до 1")
+        if not 12 <= settings['font_size'] <= 200:
+            raise ValueError("Размер шрифта должен быть от 12 до 200")
+        if not -180 <= settings['angle'] <= 180:
+            raise ValueError("Угол должен быть от -180 до 180")
+        if not 2 <= settings['density'] <= 10:
+            raise ValueError("Плотность должна быть от 2 до 10")
+
+        color = settings['color']
+        if not (color.startswith('#') and len(color) == 7
+                and all(c in '0123456789abcdefABCDEF' for c in color[1:])):
+            raise ValueError("Неверный формат цвета (должен быть #RRGGBB)")
+
+        if not 1 <= settings['workers'] <= 128:
+            raise ValueError("Количество потоков должно быть от 1 до 128")
+        if settings['engine'] not in ENGINES:
+            raise ValueError("Выберите движок обработки")
+
+    def cache_budget(self):
+        """Бюджет кэшей на один процесс: общий бюджет делится между рабочими процессами"""
+        budget = self.settings.get('cache_budget') or self.CACHE_BUDGET
+        processes = self.executor.processes if self.executor is not None else 1
+        return budget // processes
+
+    def _create_executor(self):
+        """Конвейер стадий для Pillow, если он включен, иначе пул задач"""
+        settings = self.settings
+        if self.variants:
+            # Все варианты получаются из одного декодирования в процессе, поэтому только Pillow
+            return BatchExecutor('pillow', workers=settings['workers'])
+        if settings.get('pipeline') and settings['engine'] == 'pillow':
+            return StagePipeline(stage_workers=settings.get('stage_workers'),
+                                 frame_budget=settings.get('frame_budget'))
+        return BatchExecutor(settings['engine'], workers=settings['workers'])
+
+    @property
+    def total(self):
+        """Общее количество изображений, пока подсчет не завершен — найденные на данный момент"""
+        if self._counter is not None and self._counter.total is not None:
+            return max(self._counter.total, self.discovered)
+        return self.discovered
+
+    @staticmethod
+    def output_path_for(output_folder, rel_path):
+        """Путь результата с сохранением структуры входной папки"""
+        rel_dir, image_file = os.path.split(rel_path)
+        return os.path.join(output_folder, rel_dir, f"watermarked_{image_file}")
+
+    def _output_path(self, output_folder, rel_path):
+        """Путь результата; при вариантах — путь первого варианта в его подпапке"""
+        if not self.variants or ImageScanner.is_video(rel_path):
+            return self.output_path_for(output_folder, rel_path)
+        primary = self.variants[0]
+        root, ext = os.path.splitext(self.output_path_for(primary['dir'], rel_path))
+        return root + (primary['ext'] or ext)
+
+    def _output_dirs(self, input_path, output_path):
+        if not self.variants or ImageScanner.is_video(input_path):
+            return [os.path.dirname(output_path)]
+        return [os.path.dirname(path)
+                for path in OutputVariants.outputs(input_path, output_path, self.variants)]
+
+    def _chunks(self, rel_paths):
+        chunk = []
+        for rel_path in rel_paths:
+            if self.cancel_event.is_set():
+                break
+            if not self.videos and ImageScanner.is_video(rel_path):
+                # Пути от наблюдателя за папкой приходят без фильтра
+                continue
+            self.discovered += 1
+            chunk.append(rel_path)
+            if len(chunk) >= self.CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _jobs(self, rel_paths, manifest, states, videos):
+        """Поток задач: найденные изображения, без уже актуальных, сгруппированные по разрешению.
+
+        Видео не отправляются в исполнитель, а складываются в videos.
+        """
+        input_folder = self.settings['input_folder']
+        output_folder = self.settings['output_folder']
+        created_dirs = set()
+
+        for chunk in self._chunks(rel_paths):
+            # Группируем по разрешению, чтобы слои водяного знака переиспользовались подряд
+            paths = {os.path.join(input_folder, rel_path): rel_path for rel_path in chunk}
+            groups = METADATA_INDEX.group_by_resolution(
+                [path for path, rel_path in paths.items() if not ImageScanner.is_video(rel_path)]
+            )
+            groups['video'] = [path for path, rel_path in paths.items()
+                               if ImageScanner.is_video(rel_path)]
+
+            for group in groups.values():
+                for input_path in group:
+                    rel_path = paths[input_path]
+                    output_path = self._output_path(output_folder, rel_path)
+                    try:
+                        with METRICS.stage('manifest'):
+                            current, states[rel_path] = manifest.check(rel_path, input_path,
+                                                                       output_path)
+                    except OSError as e:
+                        manifest.record_failure(rel_path, str(e))
+                        print(f"Ошибка при обработке {rel_path}: {e}")
+                        continue
+
+                    if current:
+                        # Результат уже актуален
+                        self.skipped += 1
+                        self.processed += 1
+                        self.report(self.processed, self.total, f"Пропущено {rel_path}")
+                        continue
+
+                    for output_dir in self._output_dirs(input_path, output_path):
+                        if output_dir not in created_dirs:
+                            os.makedirs(output_dir, exist_ok=True)
+                            created_dirs.add(output_dir)
+                    if ImageScanner.is_video(rel_path):
+                        videos.append((rel_path, input_path, output_path))
+                    else:
+                        yield rel_path, input_path, output_path
+
+            METADATA_INDEX.save_if_due()
+
+    def run(self):
+        """Обрабатывает папку и возвращает (обработано, всего)"""
+        METRICS.configure(self.settings.get('metrics_log'), self.settings.get('metrics_prometheus'))
+        try:
+            with METRICS.stage('batch'):
+                return self._run()
+        finally:
+            if METRICS.enabled:
+                try:
+                    METRICS.write_summary()
+                except Exception as e:
+                    print(f"Ошибка сохранения сводки метрик: {e}")
+                METRICS.configure(None)
+
+    def _run(self):
+        self.open()
+        try:
+            input_folder = self.settings['input_folder']
+            output_folder = self.settings['output_folder']
+
+            shard = self.settings.get('shard')
+
+            # Изображения находим по ходу обработки; общее количество считается параллельно
+            scanner = ImageScanner(input_folder, exclude=[output_folder], shard=shard,
+                                   videos=self.videos)
+            self._counter = ImageScanner(input_folder, exclude=[output_folder], shard=shard,
+                                         videos=self.videos)
+            self._counter.count_async()
+            self.report(0, 0, "Поиск изображений...")
+
+            self.process(scanner)
+            if not self.cancel_event.is_set():
+                self.manifest.mark_complete()
+                self.manifest.save()
+
+            if not self.discovered and shard is None:
+                # Шарду может не достаться ни одного файла, это не ошибка
+                raise Exception("В указанной папке нет изображений")
+
+            return self.processed, self.discovered
+        finally:
+            self.close()
+
+    def open(self):
+        """Готовит водяной знак, манифест и исполнитель; они остаются в памяти до close()"""
+        settings = self.settings
+
+        # Создаем водяной знак
+        self._creator = self._create_watermark(settings)
+        self.watermark_path = self._creator.create()
+        if not self.watermark_path:
+            self._creator.cleanup()
+            raise Exception("Не удалось создать водяной знак")
+        if settings.get('variants'):
+            self.variants = OutputVariants.resolve(settings['variants'], settings,
+                                                   self._variant_watermark)
+
+        # Видео обрабатываются только через ffmpeg, независимо от движка для изображений
+        self.videos = FFmpegHandler.check_ffmpeg()
+        if not self.videos:
+            print("FFmpeg не найден: видео MP4/MOV пропускаются")
+
+        # Подготавливаем папки
+        os.makedirs(settings['output_folder'], exist_ok=True)
+        self.manifest = ProcessingManifest(settings['output_folder'], settings,
+                                           shard=settings.get('shard'))
+        self.executor = self._create_executor()
+        # Кэши главного процесса служат видео, потокам ffmpeg и конвейеру
+        _configure_caches(self.config())
+
+    @staticmethod
+    def _create_watermark(settings):
+        font_path, font_index = FontManager.get_font(settings['font_name'])
+        return WatermarkCreator(
+            text=settings['text'],
+            font_path=font_path,
+            font_index=font_index,
+            font_size=settings['font_size'],
+            color=settings['color'],
+            angle=settings['angle']
+        )
+
+    def _variant_watermark(self, settings):
+        """Водяной знак для настроек варианта; одинаковые знаки создаются один раз"""
+        creator = self._create_watermark(settings)
+        if creator.key == self._creator.key:
+            return self.watermark_path
+        if creator.key not in self._variant_creators:
+            path = creator.create()
+            if not path:
+                raise Exception("Не удалось создать водяной знак")
+            self._variant_creators[creator.key] = (creator, path)
+        return self._variant_creators[creator.key][1]
+
+    def process(self, rel_paths):
+        """Обрабатывает изображения по путям относительно входной папки"""
+        states = {}
+        videos = []
+        jobs = self._jobs(rel_paths, self.manifest, states, videos)
+        try:
+            for rel_path, success, output_path in self._run_jobs(self.executor, jobs,
+                                                                 self.watermark_path):
+                self._finish_job(rel_path, success, output_path, states)
+                message = f"Обработано {rel_path}" if success else f"Ошибка: {rel_path}"
+                if isinstance(self.executor, StagePipeline):
+                    message += f" | очереди: {self.executor.describe_queues()}"
+                self.report(self.processed, self.total, message)
+
+            # Видео само распараллеливается по сегментам, поэтому обрабатывается по одному
+            for rel_path, input_path, output_path in videos:
+                if self.cancel_event.is_set():
+                    break
+                success = self._process_video(rel_path, input_path, output_path)
+                self._finish_job(rel_path, success, output_path, states)
+                self.report(self.processed, self.total,
+                            f"Обработано {rel_path}" if success else f"Ошибка: {rel_path}")
+        finally:
+            self.manifest.save()
+            # Все задачи пачки завершены: файлы вытесненных слоев больше никто не читает,
+            # иначе у долгоживущего демона они копились бы до остановки
+            LAYER_CACHE.purge_retired()
+            SCALED_CACHE.purge_retired()
+
+    def _finish_job(self, rel_path, success, output_path, states):
+        if success:
+            self.processed += 1
+            state = states.pop(rel_path)
+            if isinstance(success, str):
+                # Отпечаток, посчитанный рабочим процессом вместе с обработкой
+                state['fingerprint'] = success
+            self.manifest.record(rel_path, output_path, state)
+        else:
+            states.pop(rel_path, None)
+            self.manifest.record_failure(rel_path)
+            print(f"Ошибка при обработке {rel_path}")
+
+    def _process_video(self, rel_path, input_path, output_path):
+        """Обрабатывает видео с прогрессом по выводу ffmpeg"""
+        def progress(fraction):
+            self.report(self.processed + fraction, self.total, f"Видео {rel_path}: {fraction:.0%}")
+
+        # Как и для изображений, результат появляется под своим именем только целиком
+        temp_path = _temp_output_path(output_path)
+        with METRICS.image(input_path) as record:
+            fingerprint = _job_fingerprint(input_path, self.config())
+            success = VideoHandler.apply_watermark(input_path, self.watermark_path, temp_path,
+                                                   self.config(), progress=progress,
+                                                   workers=self.settings['workers'],
+                                                   cancel_event=self.cancel_event)
+            if success:
+                os.replace(temp_path, output_path)
+            record.success = success
+        if not success and os.path.exists(temp_path):
+            os.unlink(temp_path)
+        return (fingerprint or success) if success else False
+
+    def close(self):
+        """Освобождает рабочие процессы, временные файлы и кэши"""
+        METADATA_INDEX.save()
+        # Кэши главного процесса обслуживали конвейер, видео и потоки ffmpeg
+        METRICS.record_caches(WatermarkCreator.cache_info())
+        if self.executor is not None:
+            self.executor.close()
+            self.executor = None
+        if self._creator is not None:
+            self._creator.cleanup()
+            self._creator = None
+        for creator, _ in self._variant_creators.values():
+            creator.cleanup()
+        self._variant_creators = {}
+        LAYER_CACHE.clear()
+        SCALED_CACHE.clear()
+
+    def _run_jobs(self, executor, jobs, watermark_path):
+        """Запускает задачи и добавляет к результатам путь вывода"""
+        outputs = {}
+
+        def remember(jobs):
+            for rel_path, input_path, output_path in jobs:
+                outputs[rel_path] = output_path
+                yield rel_path, input_path, output_path
+
+        for rel_path, success in executor.run(remember(jobs), watermark_path, self.config(),
+                                              cancel_event=self.cancel_event):
+            yield rel_path, success, outputs.pop(rel_path)
+
+class InotifyWatcher:
+    """Уведомления Linux (inotify) о файлах, появившихся во входной папке"""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    # Файл считаем записанным после закрытия или переноса в папку; создание нужно только для каталогов
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, root, exclude=()):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify не поддерживается")
+        self._libc = libc
+        self.root = root
+        self.exclude = {os.path.realpath(path) for path in exclude}
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self._dirs = {}
+        self._add_tree('')
+
+    def _add_tree(self, rel_dir):
+        """Наблюдает за каталогом и вложенными в него; возвращает уже лежащие там изображения"""
+        found = []
+        pending = [rel_dir]
+        while pending:
+            rel_dir = pending.pop()
+            directory = os.path.join(self.root, rel_dir)
+            # Наблюдение ставим до чтения каталога, чтобы не пропустить файлы между ними
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                print(f"Ошибка наблюдения за папкой {directory}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self._dirs[wd] = rel_dir
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        rel_path = os.path.join(rel_dir, entry.name)
+                        if entry.is_dir(follow_symlinks=False):
+                            if os.path.realpath(entry.path) not in self.exclude:
+                                pending.append(rel_path)
+                        elif ImageScanner.is_media(entry.name):
+                            found.append(rel_path)
+            except OSError as e:
+                print(f"Ошибка чтения папки {directory}: {e}")
+        return found
+
+    def poll(self, timeout, wake_fd):
+        """Ждет событий не дольше timeout (None — без ограничения), возвращает пути изображений"""
+        readable, _, _ = select.select([self._fd, wake_fd], [], [], timeout)
+        if self._fd not in readable:
+            return []
+
+        found = []
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    # Очередь событий переполнена: пересканируем папку целиком
+                    found.extend(self._add_tree(''))
+                    continue
+                if mask & self.IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                rel_dir = self._dirs.get(wd)
+                if rel_dir is None or not name:
+                    continue
+                rel_path = os.path.join(rel_dir, name)
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO) and \
+                            os.path.realpath(os.path.join(self.root, rel_path)) not in self.exclude:
+                        found.extend(self._add_tree(rel_path))
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and ImageScanner.is_media(name):
+                    found.append(rel_path)
+        return found
+
+    def close(self):
+        os.close(self._fd)
+
+class PollingWatcher:
+    """Запасной вариант без inotify: периодически сравнивает содержимое папки"""
+    INTERVAL = 2.0
+
+    def __init__(self, root, exclude=(), interval=None):
+        self.root = root
+        self.exclude = exclude
+        self.interval = interval or self.INTERVAL
+        self._snapshot = self._scan()
+        self._next_scan = time.monotonic() + self.interval
+
+    def _scan(self):
+        snapshot = {}
+        for rel_path in ImageScanner(self.root, exclude=self.exclude):
+            try:
+                stat = os.stat(os.path.join(self.root, rel_path))
+            except OSError:
+                continue
+            snapshot[rel_path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout, wake_fd):
+        """Ждет до следующего обхода не дольше timeout, возвращает новые и измененные изображения"""
+        wait = max(0.0, self._next_scan - time.monotonic())
+        if timeout is not None and timeout < wait:
+            select.select([wake_fd], [], [], timeout)
+            return []
+        readable, _, _ = select.select([wake_fd], [], [], wait)
+        if readable:
+            return []
+
+        snapshot = self._scan()
+        self._next_scan = time.monotonic() + self.interval
+        found = [rel_path for rel_path, signature in snapshot.items()
+                 if self._snapshot.get(rel_path) != signature]
+        self._snapshot = snapshot
+        return found
+
+    def close(self):
+        pass
+
+class FolderWatchDaemon:
+    """Фоновый режим: обрабатывает изображения по мере появления во входной папке"""
+    # Файл готов, если его размер и время изменения не менялись столько секунд
+    SETTLE_SECONDS = 1.0
+    # Сколько ждать после первого готового файла, чтобы собрать поступления в одну пачку
+    BATCH_WINDOW = 0.5
+
+    def __init__(self, settings, poll=False, settle=None, window=None, report=None):
+        self.settings = settings
+        self.poll = poll
+        self.settle = self.SETTLE_SECONDS if settle is None else settle
+        self.window = self.BATCH_WINDOW if window is None else window
+        self.batch = WatermarkBatch(settings, report=report)
+        # Путь -> (размер и время изменения, когда они последний раз менялись)
+        self._pending = {}
+        self._stopped = threading.Event()
+        self._wake_read, self._wake_write = os.pipe()
+
+    def stop(self, *_):
+        """Останавливает демон; можно вызывать из обработчика сигнала"""
+        self._stopped.set()
+        self.batch.cancel_event.set()
+        try:
+            os.write(self._wake_write, b'\0')
+        except OSError:
+            pass
+
+    def _create_watcher(self):
+        exclude = [self.settings['output_folder']]
+        if not self.poll:
+            try:
+                return InotifyWatcher(self.settings['input_folder'], exclude)
+            except (OSError, AttributeError) as e:
+                print(f"inotify недоступен ({e}), используется опрос папки")
+        return PollingWatcher(self.settings['input_folder'], exclude)
+
+    def _add(self, rel_paths):
+        now = time.monotonic()
+        for rel_path in rel_paths:
+            self._pending[rel_path] = (None, now)
+
+    def _ready(self):
+        """Забирает файлы, которые перестали меняться"""
+        now = time.monotonic()
+        ready = []
+        for rel_path, (signature, changed) in list(self._pending.items()):
+            try:
+                stat = os.stat(os.path.join(self.settings['input_folder'], rel_path))
+            except OSError:
+                # Файл удалили или переименовали до обработки
+                del self._pending[rel_path]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != signature:
+                self._pending[rel_path] = (current, now)
+            elif now - changed >= self.settle:
+                del self._pending[rel_path]
+                ready.append(rel_path)
+        return ready
+
+    def _timeout(self, deadline):
+        """Сколько ждать событий: без ограничения, если ждать нечего"""
+        wakeups = [changed + self.settle for _, changed in self._pending.values()]
+        if deadline is not None:
+            wakeups.append(deadline)
+        if not wakeups:
+            return None
+        return max(0.05, min(wakeups) - time.monotonic())
+
+    def run(self):
+        """Работает до вызова stop()"""
+        settings = self.settings
+        METRICS.configure(settings.get('metrics_log'), settings.get('metrics_prometheus'))
+        self.batch.open()
+        watcher = None
+        try:
+            watcher = self._create_watcher()
+            # Догоняем то, что появилось, пока демон не работал; актуальное пропустит манифест
+            self.batch.process(ImageScanner(settings['input_folder'],
+                                            exclude=[settings['output_folder']],
+                                            videos=self.batch.videos))
+            print(f"Наблюдение за папкой {settings['input_folder']}")
+
+            ready = []
+            deadline = None
+            while not self._stopped.is_set():
+                self._add(watcher.poll(self._timeout(deadline), self._wake_read))
+                ready.extend(self._ready())
+                if ready and deadline is None:
+                    deadline = time.monotonic() + self.window
+                if deadline is not None and time.monotonic() >= deadline:
+                    self.batch.process(ready)
+                    ready = []
+                    deadline = None
+        finally:
+            if watcher is not None:
+                watcher.close()
+            self.batch.close()
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+            if METRICS.enabled:
+                try:
+                    METRICS.write_summary()
+                except Exception as e:
+                    print(f"Ошибка сохранения сводки метрик: {e}")
+                METRICS.configure(None)
+        return self.batch.processed
 
 class WatermarkApp:
+    # Период опроса очереди и минимальный интервал между сообщениями о прогрессе
+    UI_POLL_MS = 100
+    UI_REPORT_INTERVAL = 0.1
+    # Размер уменьшенной копии для предпросмотра и задержка перерисовки после изменений
+    PREVIEW_SIZE = (480, 480)
+    PREVIEW_DEBOUNCE_MS = 80
+
     def __init__(self, root):
         self.root = root
         self.root.title("Enhanced Text Watermark Tool")
-        self.root.geometry("800x800")
+        self.root.geometry("1300x800")
         
-        # Проверяем наличие ffmpeg
-        if not FFmpegHandler.check_ffmpeg():
-            messagebox.showerror(
-                "Ошибка",
-                "FFmpeg не найден! Установите FFmpeg и добавьте его в PATH."
-            )
-            self.root.quit()
-            return
-
         # Инициализация переменных
         self._init_variables()
+
+        # Проверяем наличие ffmpeg; без него остаётся встроенный движок
+        self.ffmpeg_available = FFmpegHandler.check_ffmpeg()
+        if not self.ffmpeg_available:
+            messagebox.showwarning(
+                "Предупреждение",
+                "FFmpeg не найден! Будет использован встроенный движок Pillow."
+            )
+            self.engine.set('pillow')
         
         # Создаем интерфейс
         self._create_ui()
+        self._watch_settings()
 
     def _init_variables(self):
         """Инициализация переменных"""
@@ -263,6 +3104,10 @@ class WatermarkApp:
         self.color = tk.StringVar(value="#FFFFFF")
         self.tile_enabled = tk.BooleanVar(value=True)
         self.tile_density = tk.StringVar(value="8")
+        self.engine = tk.StringVar(value="ffmpeg")
+        self.workers = tk.StringVar(value=str(os.cpu_count() or 1))
+        self.pipeline_enabled = tk.BooleanVar(value=False)
+        self.stage_workers = tk.StringVar()
         
         # Инициализация шрифта
         self.selected_font = tk.StringVar(value=FontManager.DEFAULT_FONT)
@@ -270,6 +3115,18 @@ class WatermarkApp:
         self.progress = tk.DoubleVar()
         self.status = tk.StringVar(value="Готов к работе")
 
+        # Состояние фоновой обработки
+        self._queue = queue.Queue()
+        self._worker = None
+        self._cancel_event = None
+        self._last_report = 0.0
+
+        # Предпросмотр
+        self.preview_sample = tk.StringVar()
+        self._preview_job = None
+        self._preview_proxy = None  # (ключ файла, уменьшенная копия)
+        self._preview_photo = None
+
         # Загружаем список шрифтов
         self.available_fonts = FontManager.get_system_fonts()
 
@@ -284,6 +3141,7 @@ class WatermarkApp:
         self._create_settings_section(main_frame)
         self._create_output_section(main_frame)
         self._create_progress_section(main_frame)
+        self._create_preview_section(main_frame)
 
     def _create_watermark_section(self, parent):
         """Создание секции водяного знака"""
@@ -344,6 +3202,19 @@ class WatermarkApp:
         ttk.Label(tile_frame, text="Плотность:").pack(side='left', padx=(10, 0))
         ttk.Spinbox(tile_frame, from_=2, to=10, textvariable=self.tile_density, width=5).pack(side='left')
 
+        # Движок обработки
+        engine_frame = ttk.Frame(frame)
+        engine_frame.pack(fill='x', pady=2)
+        ttk.Label(engine_frame, text="Движок:").pack(side='left')
+        ttk.Combobox(engine_frame, textvariable=self.engine, values=list(ENGINES),
+                    state='readonly', width=10).pack(side='left')
+        ttk.Label(engine_frame, text="Потоков:").pack(side='left', padx=(10, 0))
+        ttk.Spinbox(engine_frame, from_=1, to=128, textvariable=self.workers, width=5).pack(side='left')
+        ttk.Checkbutton(engine_frame, text="Конвейер (pillow)",
+                        variable=self.pipeline_enabled).pack(side='left', padx=(10, 0))
+        ttk.Label(engine_frame, text="Потоки стадий:").pack(side='left', padx=(10, 0))
+        ttk.Entry(engine_frame, textvariable=self.stage_workers, width=20).pack(side='left')
+
     def _create_output_section(self, parent):
         """Создание секции выходной папки"""
         frame = ttk.LabelFrame(parent, text="Папка для сохранения", padding="5")
@@ -359,7 +3230,97 @@ class WatermarkApp:
 
         ttk.Progressbar(frame, variable=self.progress, mode='determinate').pack(fill='x', pady=5)
         ttk.Label(frame, textvariable=self.status).pack()
-        ttk.Button(frame, text="Начать обработку", command=self._process_images).pack(pady=5)
+
+        buttons = ttk.Frame(frame)
+        buttons.pack(pady=5)
+        self.start_button = ttk.Button(buttons, text="Начать обработку", command=self._process_images)
+        self.start_button.pack(side='left', padx=5)
+        self.cancel_button = ttk.Button(buttons, text="Отмена", command=self._cancel_processing,
+                                        state='disabled')
+        self.cancel_button.pack(side='left', padx=5)
+
+    def _create_preview_section(self, parent):
+        """Создание секции предпросмотра"""
+        frame = ttk.LabelFrame(parent, text="Предпросмотр", padding="5")
+        frame.grid(row=0, column=1, rowspan=5, sticky='nsew', padx=(10, 0), pady=5)
+
+        ttk.Button(frame, text="Выбрать образец", command=self._select_preview_sample).pack(anchor='w')
+        self.preview_label = ttk.Label(frame, text="Выберите папку с изображениями или образец",
+                                       anchor='center')
+        self.preview_label.pack(fill='both', expand=True, pady=5)
+
+    def _watch_settings(self):
+        """Перерисовывает предпросмотр при изменении любой настройки"""
+        for var in (self.watermark_text, self.selected_font, self.font_size, self.opacity,
+                    self.angle, self.color, self.tile_enabled, self.tile_density,
+                    self.preview_sample):
+            var.trace_add('write', self._schedule_preview)
+
+    def _schedule_preview(self, *_):
+        """Откладывает перерисовку, пока пользователь печатает или крутит значения"""
+        if self._preview_job is not None:
+            self.root.after_cancel(self._preview_job)
+        self._preview_job = self.root.after(self.PREVIEW_DEBOUNCE_MS, self._update_preview)
+
+    def _load_preview_proxy(self, path):
+        """Уменьшенная копия образца; декодируется один раз на файл"""
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if self._preview_proxy is None or self._preview_proxy[0] != key:
+            with Image.open(path) as img:
+                # Для JPEG сразу декодируем в уменьшенном размере
+                img.draft(img.mode, self.PREVIEW_SIZE)
+                proxy = img.convert('RGBA')
+            proxy.thumbnail(self.PREVIEW_SIZE, Image.BICUBIC)
+            self._preview_proxy = (key, proxy)
+        return self._preview_proxy[1]
+
+    def _update_preview(self):
+        """Накладывает водяной знак на уменьшенную копию образца"""
+        self._preview_job = None
+        sample = self.preview_sample.get()
+        if not sample:
+            return
+
+        try:
+            # Пока значение набирается, оно может быть неполным: просто ждем следующего изменения
+            opacity = float(self.opacity.get())
+            density = int(self.tile_density.get())
+            if not (0 <= opacity <= 1 and 2 <= density <= 10):
+                return
+            font_path, font_index = FontManager.get_font(self.selected_font.get())
+            creator = WatermarkCreator(
+                text=self.watermark_text.get(),
+                font_path=font_path,
+                font_index=font_index,
+                font_size=int(self.font_size.get()),
+                color=self.color.get(),
+                angle=float(self.angle.get())
+            )
+            # Отрисовка водяного знака и масштабированные варианты берутся из кэшей,
+            # поэтому пересчитывается только изменившийся шаг
+            watermark = creator.render()
+            config = {'opacity': opacity, 'tile_enabled': self.tile_enabled.get(), 'density': density}
+            image = PillowHandler.composite(self._load_preview_proxy(sample).copy(), watermark,
+                                            config, watermark_key=('preview',) + creator.key)
+        except ValueError:
+            return
+        except Exception as e:
+            self._preview_photo = None
+            self.preview_label.config(image='', text=f"Ошибка предпросмотра: {e}")
+            return
+
+        self._preview_photo = ImageTk.PhotoImage(image)
+        self.preview_label.config(image=self._preview_photo, text='')
+
+    def _select_preview_sample(self):
+        """Выбор изображения для предпросмотра"""
+        path = filedialog.askopenfilename(
+            title="Выберите образец",
+            filetypes=[("Изображения", ' '.join(f'*{ext}' for ext in ImageScanner.IMAGE_EXTENSIONS))]
+        )
+        if path:
+            self.preview_sample.set(path)
 
     def _select_input_folder(self):
         """Выбор входной папки"""
@@ -368,6 +3329,12 @@ class WatermarkApp:
             self.images_folder.set(folder)
             # Автоматически устанавливаем выходную папку
             self.output_path.set(os.path.join(folder, "watermarked"))
+            # Первое найденное изображение становится образцом для предпросмотра
+            if not self.preview_sample.get():
+                scanner = ImageScanner(folder, exclude=[self.output_path.get()])
+                first = next((path for path in scanner if ImageScanner.is_image(path)), None)
+                if first:
+                    self.preview_sample.set(os.path.join(folder, first))
 
     def _select_output_folder(self):
         """Выбор выходной папки"""
@@ -390,121 +3357,291 @@ class WatermarkApp:
             return False
         
         try:
-            # Проверяем числовые значения
-            opacity = float(self.opacity.get())
-            if not 0 <= opacity <= 1:
-                raise ValueError("Прозрачность должна быть от 0 до 1")
-
-            font_size = int(self.font_size.get())
-            if not 12 <= font_size <= 200:
-                raise ValueError("Размер шрифта должен быть от 12 до 200")
-
-            angle = float(self.angle.get())
-            if not -180 <= angle <= 180:
-                raise ValueError("Угол должен быть от -180 до 180")
-
-            density = int(self.tile_density.get())
-            if not 2 <= density <= 10:
-                raise ValueError("Плотность должна быть от 2 до 10")
-
-            # Проверяем цвет
-            color = self.color.get()
-            if not (color.startswith('#') and len(color) == 7):
-                raise ValueError("Неверный формат цвета (должен быть #RRGGBB)")
-
             # Проверяем шрифт
             if not self.selected_font.get():
                 raise ValueError("Выберите шрифт")
 
+            # Числовые значения, цвет и движок проверяются так же, как в командной строке
+            WatermarkBatch.validate(self._collect_settings())
+            if self.engine.get() == 'ffmpeg' and not self.ffmpeg_available:
+                raise ValueError("FFmpeg не найден, выберите движок pillow")
+
             return True
 
         except ValueError as e:
             messagebox.showwarning("Предупреждение", str(e))
             return False
 
+    def _collect_settings(self):
+        """Собирает настройки обработки из переменных интерфейса"""
+        return {
+            'text': self.watermark_text.get(),
+            'font_name': self.selected_font.get(),
+            'font_size': int(self.font_size.get()),
+            'color': self.color.get(),
+            'angle': float(self.angle.get()),
+            'opacity': float(self.opacity.get()),
+            'tile_enabled': self.tile_enabled.get(),
+            'density': int(self.tile_density.get()),
+            'engine': self.engine.get(),
+            'workers': int(self.workers.get()),
+            'pipeline': self.pipeline_enabled.get(),
+            'stage_workers': StagePipeline.parse_workers(self.stage_workers.get()),
+            # Метрики включаются переменными окружения
+            'metrics_log': os.environ.get('WATERMARK_METRICS_LOG'),
+            'metrics_prometheus': os.environ.get('WATERMARK_METRICS_PROM'),
+            'input_folder': self.images_folder.get(),
+            'output_folder': self.output_path.get(),
+        }
+
     def _process_images(self):
-        """Обработка изображений"""
-        if not self._validate_inputs():
+        """Запуск обработки изображений в фоновом потоке"""
+        if self._worker is not None or not self._validate_inputs():
             return
 
+        self._cancel_event = threading.Event()
+        self._last_report = 0.0
+        self.progress.set(0)
+        self.status.set("Подготовка...")
+        self.start_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
+
+        self._worker = threading.Thread(
+            target=self._run_batch, args=(self._collect_settings(),), daemon=True
+        )
+        self._worker.start()
+        self.root.after(self.UI_POLL_MS, self._poll_queue)
+
+    def _cancel_processing(self):
+        """Отмена обработки после завершения текущих задач"""
+        if self._worker is not None:
+            self._cancel_event.set()
+            self.status.set("Отмена...")
+            self.cancel_button.config(state='disabled')
+
+    def _run_batch(self, settings):
+        """Выполняется в фоновом потоке; общается с интерфейсом только через очередь"""
         try:
-            # Создаем водяной знак
-            creator = WatermarkCreator(
-                text=self.watermark_text.get(),
-                font_path=FontManager.get_font_path(self.selected_font.get()),
-                font_size=int(self.font_size.get()),
-                color=self.color.get(),
-                angle=float(self.angle.get())
-            )
-            
-            watermark_path = creator.create()
-            if not watermark_path:
-                raise Exception("Не удалось создать водяной знак")
-
-            # Подготавливаем папки
-            input_folder = self.images_folder.get()
-            output_folder = self.output_path.get()
-            os.makedirs(output_folder, exist_ok=True)
-
-            # Получаем список изображений
-            images = [f for f in os.listdir(input_folder) 
-                     if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-
-            if not images:
-                raise Exception("В указанной папке нет изображений")
-
-            # Конфигурация для обработки
-            config = {
-                'opacity': float(self.opacity.get()),
-                'tile_enabled': self.tile_enabled.get(),
-                'density': int(self.tile_density.get())
-            }
-
-            # Обрабатываем изображения
-            self.progress.set(0)
-            total_files = len(images)
-            processed = 0
-
-            for image_file in images:
-                try:
-                    input_path = os.path.join(input_folder, image_file)
-                    output_path = os.path.join(output_folder, f"watermarked_{image_file}")
-
-                    self.status.set(f"Обработка {image_file}...")
-                    if FFmpegHandler.apply_watermark(input_path, watermark_path, output_path, config):
-                        processed += 1
-                    else:
-                        print(f"Ошибка при обработке {image_file}")
-
-                except Exception as e:
-                    print(f"Ошибка при обработке {image_file}: {e}")
-                    continue
+            batch = WatermarkBatch(settings, report=self._report,
+                                   cancel_event=self._cancel_event)
+            processed, total = batch.run()
+            self._queue.put(('done', processed, total, self._cancel_event.is_set()))
+        except Exception as e:
+            self._queue.put(('error', str(e)))
 
-                finally:
-                    # Обновляем прогресс
-                    self.progress.set((processed / total_files) * 100)
-                    self.root.update()
+    def _report(self, processed, total, message):
+        """Передает прогресс в очередь не чаще UI_REPORT_INTERVAL"""
+        now = time.monotonic()
+        if now - self._last_report < self.UI_REPORT_INTERVAL and processed < total:
+            return
+        self._last_report = now
+        self._queue.put(('progress', processed, total, message))
 
-            # Очистка
-            creator.cleanup()
+    def _poll_queue(self):
+        """Разбирает очередь сообщений фонового потока по таймеру"""
+        last_progress = None
+        try:
+            while True:
+                item = self._queue.get_nowait()
+                if item[0] == 'progress':
+                    last_progress = item
+                else:
+                    self._finish(item)
+                    return
+        except queue.Empty:
+            pass
+
+        # Применяем только последнее состояние, пропуская промежуточные
+        if last_progress is not None:
+            _, processed, total, message = last_progress
+            self.progress.set((processed / total) * 100 if total else 0)
+            self.status.set(message)
+        self.root.after(self.UI_POLL_MS, self._poll_queue)
+
+    def _finish(self, item):
+        """Завершение обработки в главном потоке"""
+        self._worker = None
+        self.start_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
+
+        if item[0] == 'error':
+            messagebox.showerror("Ошибка", item[1])
+            self.status.set("Произошла ошибка")
+            return
 
-            # Итоговое сообщение
-            if processed == total_files:
-                self.status.set("Обработка завершена успешно!")
-                messagebox.showinfo("Успех", f"Обработано {processed} изображений")
-            else:
-                self.status.set("Обработка завершена с ошибками")
-                messagebox.showwarning("Предупреждение", 
-                    f"Обработано {processed} из {total_files} изображений")
+        _, processed, total_files, cancelled = item
+        self.progress.set((processed / total_files) * 100 if total_files else 0)
 
-        except Exception as e:
-            messagebox.showerror("Ошибка", str(e))
-            self.status.set("Произошла ошибка")
+        # Итоговое сообщение
+        if cancelled:
+            self.status.set("Обработка отменена")
+            messagebox.showinfo("Отменено", f"Обработано {processed} из {total_files} изображений")
+        elif processed == total_files:
+            self.status.set("Обработка завершена успешно!")
+            messagebox.showinfo("Успех", f"Обработано {processed} изображений")
+        else:
+            self.status.set("Обработка завершена с ошибками")
+            messagebox.showwarning("Предупреждение", 
+                f"Обработано {processed} из {total_files} изображений")
+
+def _add_settings_arguments(parser):
+    """Параметры водяного знака и обработки, общие для команд без интерфейса"""
+    parser.add_argument('input_folder', help="папка с изображениями")
+    parser.add_argument('output_folder', help="папка для результатов")
+    parser.add_argument('--text', default="@lirahush", help="текст водяного знака")
+    parser.add_argument('--font', default=FontManager.DEFAULT_FONT, help="название шрифта")
+    parser.add_argument('--font-size', type=int, default=100)
+    parser.add_argument('--color', default="#FFFFFF")
+    parser.add_argument('--angle', type=float, default=45)
+    parser.add_argument('--opacity', type=float, default=0.1)
+    parser.add_argument('--no-tile', action='store_true', help="один знак по центру вместо тайлинга")
+    parser.add_argument('--density', type=int, default=8, help="плотность тайлинга (2-10)")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='pillow')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--pipeline', action='store_true',
+                        help="конвейер стадий вместо пула процессов (только pillow)")
+    parser.add_argument('--stage-workers', type=_parse_stage_workers,
+                        help="потоки стадий конвейера, например read=4,decode=8,composite=8,write=4")
+    parser.add_argument('--frame-budget', type=int,
+                        help="память под декодированные кадры конвейера, МБ "
+                             f"(по умолчанию {StagePipeline.FRAME_BUDGET // (1024 * 1024)})")
+    parser.add_argument('--memory-budget', type=int,
+                        help="память на рабочие буферы одного изображения, МБ: большие кадры "
+                             "обрабатываются полосами "
+                             f"(по умолчанию {PillowHandler.MEMORY_BUDGET // (1024 * 1024)})")
+    parser.add_argument('--cache-budget', type=int,
+                        help="общий объем кэшей водяного знака на все процессы, МБ "
+                             f"(по умолчанию {WatermarkBatch.CACHE_BUDGET // (1024 * 1024)})")
+    parser.add_argument('--variants', help="JSON со списком выходных вариантов (размер, формат, "
+                                           "качество, водяной знак)")
+
+def _settings_from_args(args):
+    """Настройки обработки в том же виде, что собирает интерфейс"""
+    if args.engine == 'ffmpeg' and not FFmpegHandler.check_ffmpeg():
+        raise Exception("FFmpeg не найден, используйте --engine pillow")
+    settings = {
+        'text': args.text,
+        'font_name': args.font,
+        'font_size': args.font_size,
+        'color': args.color,
+        'angle': args.angle,
+        'opacity': args.opacity,
+        'tile_enabled': not args.no_tile,
+        'density': args.density,
+        'engine': args.engine,
+        'workers': args.workers,
+        'pipeline': args.pipeline,
+        'stage_workers': args.stage_workers,
+        'frame_budget': args.frame_budget * 1024 * 1024 if args.frame_budget else None,
+        'memory_budget': args.memory_budget * 1024 * 1024 if args.memory_budget else None,
+        'cache_budget': args.cache_budget * 1024 * 1024 if args.cache_budget else None,
+        'metrics_log': os.environ.get('WATERMARK_METRICS_LOG'),
+        'metrics_prometheus': os.environ.get('WATERMARK_METRICS_PROM'),
+        'input_folder': os.path.abspath(args.input_folder),
+        'output_folder': os.path.abspath(args.output_folder),
+        'variants': OutputVariants.load(args.variants) if args.variants else None,
+    }
+    WatermarkBatch.validate(settings)
+    return settings
+
+def _parse_stage_workers(value):
+    try:
+        return StagePipeline.parse_workers(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def _parse_shard(value):
+    """Шард в виде «номер/количество», номер с нуля"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("ожидается НОМЕР/КОЛИЧЕСТВО, например 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("номер шарда должен быть от 0 до КОЛИЧЕСТВО-1")
+    return index, count
+
+def _print_report(processed, total, message):
+    print(message, flush=True)
+
+def _watch(args):
+    settings = _settings_from_args(args)
+    if not os.path.isdir(settings['input_folder']):
+        raise Exception(f"Папка не найдена: {settings['input_folder']}")
+    daemon = FolderWatchDaemon(settings, poll=args.poll, settle=args.settle,
+                               window=args.window, report=_print_report)
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    processed = daemon.run()
+    print(f"Остановлено, обработано {processed} изображений")
+    return 0
+
+def _batch(args):
+    settings = _settings_from_args(args)
+    settings['shard'] = args.shard
+    processed, total = WatermarkBatch(settings, report=_print_report).run()
+    print(f"Обработано {processed} из {total} изображений")
+    return 0 if processed == total else 1
+
+def _merge(args):
+    input_folder = os.path.abspath(args.input_folder)
+    output_folder = os.path.abspath(args.output_folder)
+    result = ProcessingManifest.merge(input_folder, output_folder, args.shards)
+
+    for index in result['missing_shards']:
+        print(f"Нет манифеста шарда {index}/{args.shards}")
+    for index in result['incomplete_shards']:
+        print(f"Шард {index}/{args.shards} не завершен")
+    for rel_path, error in result['failed'].items():
+        print(f"Ошибка: {rel_path}: {error}")
+    for rel_path in result['missing']:
+        print(f"Не обработано: {rel_path}")
+    print(f"Обработано {result['processed']}, с ошибками {len(result['failed'])}, "
+          f"не обработано {len(result['missing'])}")
+
+    covered = not (result['missing'] or result['failed'] or result['missing_shards']
+                   or result['incomplete_shards'])
+    return 0 if covered else 1
 
 def main():
-    root = tk.Tk()
-    app = WatermarkApp(root)
-    root.mainloop()
+    if len(sys.argv) == 1:
+        _import_tk()
+        root = tk.Tk()
+        app = WatermarkApp(root)
+        root.mainloop()
+        return 0
+
+    parser = argparse.ArgumentParser(description="Наложение водяных знаков на изображения")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    watch = commands.add_parser('watch', help="следить за папкой и обрабатывать новые изображения")
+    _add_settings_arguments(watch)
+    watch.add_argument('--poll', action='store_true', help="опрашивать папку вместо inotify")
+    watch.add_argument('--settle', type=float, default=FolderWatchDaemon.SETTLE_SECONDS,
+                       help="сколько секунд файл не должен меняться перед обработкой")
+    watch.add_argument('--window', type=float, default=FolderWatchDaemon.BATCH_WINDOW,
+                       help="окно сбора новых файлов в одну пачку, секунды")
+    watch.set_defaults(handler=_watch)
+
+    batch = commands.add_parser('batch', help="обработать папку без интерфейса")
+    _add_settings_arguments(batch)
+    batch.add_argument('--shard', type=_parse_shard,
+                       help="обработать только свою часть файлов, НОМЕР/КОЛИЧЕСТВО (например 0/4)")
+    batch.set_defaults(handler=_batch)
+
+    merge = commands.add_parser('merge', help="слить манифесты шардов и проверить покрытие")
+    merge.add_argument('input_folder', help="папка с изображениями")
+    merge.add_argument('output_folder', help="общая папка результатов шардов")
+    merge.add_argument('--shards', type=int, required=True, help="количество шардов")
+    merge.set_defaults(handler=_merge)
+
+    args = parser.parse_args()
+    try:
+        return args.handler(args)
+    except Exception as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Нужно для рабочих процессов в собранном приложении
+    multiprocessing.freeze_support()
+    sys.exit(main())
\ No newline at end of file
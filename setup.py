@@ -7,5 +7,8 @@ setup(
     install_requires=[
         "Pillow",
     ],
+    extras_require={
+        "dev": ["pyflakes"],
+    },
     python_requires=">=3.7",
 )
\ No newline at end of file
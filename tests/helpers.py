@@ -0,0 +1,31 @@
+"""Общая подготовка тестов: путь к script.py и водяной знак по умолчанию"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import script
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Тест с временной папкой self.temp, удаляемой после теста"""
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+
+
+class WatermarkTestCase(TempDirTestCase):
+    """Тест с водяным знаком '@test' в self.watermark_path; кэши знака очищаются после теста"""
+
+    def setUp(self):
+        super().setUp()
+        font_path, font_index = script.FontManager.get_font(script.FontManager.DEFAULT_FONT)
+        self.creator = script.WatermarkCreator('@test', font_path, 100, '#FFFFFF', 45,
+                                               font_index=font_index)
+        self.watermark_path = self.creator.create()
+        self.addCleanup(self.creator.cleanup)
+        self.addCleanup(script.LAYER_CACHE.clear)
+        self.addCleanup(script.SCALED_CACHE.clear)
@@ -0,0 +1,48 @@
+import os
+import shutil
+import unittest
+
+from PIL import Image, ImageChops, ImageStat
+
+from helpers import WatermarkTestCase, script
+
+
+@unittest.skipUnless(shutil.which('ffmpeg'), "нужен ffmpeg")
+class EnginesMatchTest(WatermarkTestCase):
+    """Pillow и ffmpeg дают один результат с точностью до округления смешивания"""
+    # Наибольшее расхождение канала и среднее расхождение по кадру, в уровнях 0..255
+    MAX_DIFF = 3
+    MEAN_DIFF = 1.0
+
+    def setUp(self):
+        super().setUp()
+        self.input_path = os.path.join(self.temp.name, 'in.png')
+        Image.radial_gradient('L').resize((640, 480)).convert('RGB').save(self.input_path)
+
+    def render(self, handler, config, name):
+        output_path = os.path.join(self.temp.name, name)
+        self.assertTrue(handler.apply_watermark(self.input_path, self.watermark_path,
+                                                output_path, config))
+        with Image.open(output_path) as image:
+            return image.convert('RGB')
+
+    def test_centered_and_tiled(self):
+        with Image.open(self.input_path) as image:
+            original = image.convert('RGB')
+        for tiled in (False, True):
+            with self.subTest(tiled=tiled):
+                config = {'opacity': 0.4, 'tile_enabled': tiled, 'density': 4}
+                pillow = self.render(script.PillowHandler, config, f'pillow_{tiled}.png')
+                ffmpeg = self.render(script.FFmpegHandler, config, f'ffmpeg_{tiled}.png')
+
+                # Знак действительно наложен, иначе совпадение ничего не доказывает
+                self.assertGreater(max(high for _, high in
+                                       ImageChops.difference(original, pillow).getextrema()),
+                                   self.MAX_DIFF * 10)
+                diff = ImageChops.difference(pillow, ffmpeg)
+                self.assertLessEqual(max(high for _, high in diff.getextrema()), self.MAX_DIFF)
+                self.assertLessEqual(max(ImageStat.Stat(diff).mean), self.MEAN_DIFF)
+
+
+if __name__ == '__main__':
+    unittest.main()
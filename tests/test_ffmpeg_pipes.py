@@ -0,0 +1,57 @@
+import os
+import shutil
+import unittest
+
+from PIL import Image
+
+from helpers import WatermarkTestCase, script
+
+
+@unittest.skipUnless(shutil.which('ffmpeg') and script.FFmpegHandler.PIPE_INPUTS,
+                     "нужен ffmpeg и POSIX")
+class PipeInputsTest(WatermarkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.inputs = []
+        for index, size in enumerate([(640, 480), (640, 480), (500, 700)]):
+            path = os.path.join(self.temp.name, f'in{index}.jpg')
+            Image.radial_gradient('L').resize(size).convert('RGB').save(path, quality=90)
+            self.inputs.append(path)
+        self.addCleanup(setattr, script.FFmpegHandler, 'PIPE_INPUTS', True)
+
+    def run_engine(self, pipe_inputs, config, folder):
+        script.FFmpegHandler.PIPE_INPUTS = pipe_inputs
+        os.makedirs(os.path.join(self.temp.name, folder))
+        outputs = [os.path.join(self.temp.name, folder, os.path.basename(path))
+                   for path in self.inputs]
+        # Два кадра одного размера идут пакетом, третий — отдельным вызовом
+        results = script.FFmpegHandler.apply_watermark_batch(
+            list(zip(self.inputs[:2], outputs[:2])), self.watermark_path, config
+        )
+        results.append(script.FFmpegHandler.apply_watermark(self.inputs[2], self.watermark_path,
+                                                            outputs[2], config))
+        self.assertEqual(results, [True, True, True])
+        return outputs
+
+    def test_pipe_matches_file_input(self):
+        for tiled in (True, False):
+            config = {'opacity': 0.4, 'tile_enabled': tiled, 'density': 4}
+            files = self.run_engine(False, config, f'file_{tiled}')
+            pipes = self.run_engine(True, config, f'pipe_{tiled}')
+            for file_output, pipe_output in zip(files, pipes):
+                with open(file_output, 'rb') as a, open(pipe_output, 'rb') as b:
+                    self.assertEqual(a.read(), b.read(), pipe_output)
+
+    def test_render_in_memory(self):
+        config = {'opacity': 0.4, 'tile_enabled': True, 'density': 4}
+        output = os.path.join(self.temp.name, 'out.png')
+        self.assertTrue(script.FFmpegHandler.apply_watermark(self.inputs[0], self.watermark_path,
+                                                             output, config))
+        with open(self.inputs[0], 'rb') as f:
+            data = script.FFmpegHandler.render(f.read(), self.watermark_path, config, 'png')
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
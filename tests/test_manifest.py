@@ -0,0 +1,133 @@
+import os
+import unittest
+
+from PIL import Image
+
+from helpers import TempDirTestCase, script
+
+
+class ShardMergeTest(TempDirTestCase):
+    SHARDS = 3
+
+    def setUp(self):
+        super().setUp()
+        self.input_folder = os.path.join(self.temp.name, 'in')
+        self.output_folder = os.path.join(self.temp.name, 'out')
+        os.makedirs(self.input_folder)
+        for index in range(9):
+            Image.new('RGB', (320, 240), (index * 25, 80, 160)).save(
+                os.path.join(self.input_folder, f'{index}.jpg'))
+        with open(os.path.join(self.input_folder, 'broken.jpg'), 'wb') as f:
+            f.write(b'not a jpeg')
+
+        self.settings = {
+            'text': '@test', 'font_name': script.FontManager.DEFAULT_FONT, 'font_size': 100,
+            'color': '#FFFFFF', 'angle': 45, 'opacity': 0.3, 'tile_enabled': True, 'density': 2,
+            'engine': 'pillow', 'workers': 1, 'pipeline': False, 'stage_workers': None,
+            'input_folder': self.input_folder, 'output_folder': self.output_folder,
+        }
+
+    def run_shard(self, index):
+        settings = dict(self.settings, shard=(index, self.SHARDS))
+        return script.WatermarkBatch(settings).run()
+
+    def merge(self):
+        return script.ProcessingManifest.merge(self.input_folder, self.output_folder, self.SHARDS)
+
+    def test_deleted_failure_does_not_block_coverage(self):
+        for index in range(self.SHARDS):
+            self.run_shard(index)
+        result = self.merge()
+        self.assertEqual(list(result['failed']), ['broken.jpg'])
+        self.assertEqual(result['missing'], [])
+        self.assertEqual(result['processed'], 9)
+
+        # Удаленный файл больше не входит в покрытие, даже до повторного запуска шарда
+        os.unlink(os.path.join(self.input_folder, 'broken.jpg'))
+        self.assertEqual(self.merge()['failed'], {})
+
+        # Завершенный шард забывает файлы, которых больше нет во входной папке
+        shard = (script.shard_of('broken.jpg', self.SHARDS), self.SHARDS)
+        self.run_shard(shard[0])
+        data = script.ProcessingManifest.read(
+            script.ProcessingManifest.path_for(self.output_folder, shard))
+        self.assertNotIn('broken.jpg', data['failed'])
+        result = self.merge()
+        self.assertEqual((result['failed'], result['missing'], result['processed']), ({}, [], 9))
+
+    def test_missing_output_is_reported(self):
+        for index in range(self.SHARDS):
+            self.run_shard(index)
+        os.unlink(os.path.join(self.output_folder, 'watermarked_3.jpg'))
+        self.assertEqual(self.merge()['missing'], ['3.jpg'])
+
+
+class IncrementalBatchTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_folder = os.path.join(self.temp.name, 'in')
+        self.output_folder = os.path.join(self.temp.name, 'out')
+        os.makedirs(self.input_folder)
+        for index in range(6):
+            Image.new('RGB', (320, 240), (index * 40, 80, 160)).save(
+                os.path.join(self.input_folder, f'{index}.jpg'))
+        self.settings = {
+            'text': '@test', 'font_name': script.FontManager.DEFAULT_FONT, 'font_size': 100,
+            'color': '#FFFFFF', 'angle': 45, 'opacity': 0.3, 'tile_enabled': True, 'density': 2,
+            'engine': 'pillow', 'workers': 2, 'pipeline': False, 'stage_workers': None,
+            'input_folder': self.input_folder, 'output_folder': self.output_folder,
+        }
+
+    def run_batch(self, **overrides):
+        batch = script.WatermarkBatch(dict(self.settings, **overrides))
+        processed, total = batch.run()
+        return batch.skipped, processed, total
+
+    def entries(self):
+        return script.ProcessingManifest.read(
+            script.ProcessingManifest.path_for(self.output_folder))['entries']
+
+    def test_skip_and_redo(self):
+        self.assertEqual(self.run_batch(), (0, 6, 6))
+        # Отпечатки посчитаны рабочими процессами и совпадают с содержимым входов
+        for name, entry in self.entries().items():
+            self.assertEqual(entry['fingerprint'], script.ProcessingManifest.fingerprint(
+                os.path.join(self.input_folder, name)))
+
+        self.assertEqual(self.run_batch(), (6, 6, 6))
+
+        # Новое время изменения без изменения содержимого не требует обработки
+        touched = os.path.join(self.input_folder, '0.jpg')
+        os.utime(touched, ns=(1, 1))
+        self.assertEqual(self.run_batch(), (6, 6, 6))
+        self.assertEqual(self.entries()['0.jpg']['mtime'], 1)
+
+        # Измененное содержимое и удаленный результат обрабатываются заново
+        Image.new('RGB', (320, 240), (255, 0, 0)).save(os.path.join(self.input_folder, '1.jpg'))
+        os.unlink(os.path.join(self.output_folder, 'watermarked_2.jpg'))
+        self.assertEqual(self.run_batch(), (4, 6, 6))
+
+        # Другие настройки водяного знака делают устаревшими все результаты
+        self.assertEqual(self.run_batch(opacity=0.5), (0, 6, 6))
+
+    def test_new_files_are_fingerprinted_by_workers(self):
+        manifest = script.ProcessingManifest(self.output_folder, self.settings)
+        input_path = os.path.join(self.input_folder, '0.jpg')
+        current, state = manifest.check('0.jpg', input_path,
+                                        os.path.join(self.output_folder, 'watermarked_0.jpg'))
+        self.assertFalse(current)
+        self.assertIsNone(state['fingerprint'])
+
+    def test_failed_image_leaves_no_partial_output(self):
+        with open(os.path.join(self.input_folder, 'broken.jpg'), 'wb') as f:
+            f.write(b'\xff\xd8\xff\xe0 truncated jpeg')
+        self.assertEqual(self.run_batch(), (0, 6, 7))
+        self.assertEqual(sorted(os.listdir(self.output_folder)),
+                         sorted([script.ProcessingManifest.FILENAME]
+                                + [f'watermarked_{index}.jpg' for index in range(6)]))
+        data = script.ProcessingManifest.read(script.ProcessingManifest.path_for(self.output_folder))
+        self.assertIn('broken.jpg', data['failed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import threading
+import unittest
+
+from PIL import Image
+
+from helpers import WatermarkTestCase, script
+
+
+class FrameBudgetPipeline(script.StagePipeline):
+    """Конвейер, запоминающий наибольший объем кадров в работе"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.peak = 0
+        self._peak_lock = threading.Lock()
+
+    def _acquire_frame(self, job, size):
+        super()._acquire_frame(job, size)
+        with self._peak_lock:
+            self.peak = max(self.peak, self._frame_bytes)
+
+
+class StagePipelineTest(WatermarkTestCase):
+    SIZE = (400, 300)
+
+    def setUp(self):
+        super().setUp()
+        self.jobs = []
+        for index in range(24):
+            input_path = os.path.join(self.temp.name, f'{index}.png')
+            Image.new('RGB', self.SIZE, (index * 10, 90, 120)).save(input_path)
+            self.jobs.append((str(index), input_path, os.path.join(self.temp.name, f'out_{index}.png')))
+
+    def test_decoded_frames_stay_within_budget(self):
+        frame_bytes = self.SIZE[0] * self.SIZE[1] * 8
+        pipeline = FrameBudgetPipeline(stage_workers={'decode': 8, 'composite': 8, 'write': 8},
+                                       frame_budget=frame_bytes * 3)
+        config = {'opacity': 0.3, 'tile_enabled': True, 'density': 4}
+        results = dict(pipeline.run(self.jobs, self.watermark_path, config))
+
+        self.assertEqual(results, {name: True for name, _, _ in self.jobs})
+        self.assertLessEqual(pipeline.peak, frame_bytes * 3)
+        self.assertEqual(pipeline._frame_bytes, 0)
+
+    def test_frame_larger_than_budget_still_runs(self):
+        pipeline = script.StagePipeline(stage_workers={'decode': 4, 'composite': 4, 'write': 4},
+                                        frame_budget=1)
+        config = {'opacity': 0.3, 'tile_enabled': False, 'density': 2}
+        results = dict(pipeline.run(self.jobs[:4], self.watermark_path, config))
+        self.assertTrue(all(results.values()))
+
+    def test_parse_workers(self):
+        self.assertEqual(script.StagePipeline.parse_workers('decode=8, write=2'),
+                         {'decode': 8, 'write': 2})
+        self.assertIsNone(script.StagePipeline.parse_workers(''))
+        for value in ('decode', 'resize=2', 'write=0'):
+            with self.assertRaises(ValueError):
+                script.StagePipeline.parse_workers(value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from helpers import script
+
+
+class ValidateSettingsTest(unittest.TestCase):
+    SETTINGS = {'text': '@test', 'font_name': script.FontManager.DEFAULT_FONT, 'font_size': 100,
+                'color': '#FFFFFF', 'angle': 45, 'opacity': 0.3, 'tile_enabled': True,
+                'density': 8, 'engine': 'pillow', 'workers': 4}
+
+    def test_defaults_are_valid(self):
+        script.WatermarkBatch.validate(self.SETTINGS)
+
+    def test_out_of_range_values_are_rejected(self):
+        for field, value in (('density', 1), ('density', 11), ('opacity', 7), ('opacity', -0.1),
+                             ('font_size', 5), ('angle', 270), ('color', 'red'),
+                             ('color', '#GG0000'), ('workers', 0), ('engine', 'gpu')):
+            with self.subTest(field=field, value=value), self.assertRaises(ValueError):
+                script.WatermarkBatch.validate(dict(self.SETTINGS, **{field: value}))
+
+    def test_command_line_settings_are_validated(self):
+        parser = script.argparse.ArgumentParser()
+        script._add_settings_arguments(parser)
+        args = parser.parse_args(['in', 'out', '--density', '1'])
+        with self.assertRaises(ValueError):
+            script._settings_from_args(args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import unittest
+
+from PIL import Image, ImageChops
+
+from helpers import WatermarkTestCase, script
+
+
+class VariantsTest(WatermarkTestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_path = os.path.join(self.temp.name, 'photo.jpg')
+        Image.radial_gradient('L').resize((800, 600)).convert('RGB').save(self.input_path, quality=90)
+
+    def render_variants(self, budget, folder):
+        config = {'opacity': 0.5, 'tile_enabled': False, 'density': 2}
+        variants = [
+            {'name': name, 'dir': os.path.join(self.temp.name, folder, name), 'ext': '.png',
+             'quality': None, 'max_size': max_size, 'watermark_path': self.watermark_path,
+             'config': config}
+            for name, max_size in (('full', None), ('web', 400))
+        ]
+        outputs = [os.path.join(variant['dir'], 'photo.png') for variant in variants]
+        for output in outputs:
+            os.makedirs(os.path.dirname(output))
+        success = script.PillowHandler.apply_variants(
+            self.input_path, outputs, dict(config, variants=variants, memory_budget=budget)
+        )
+        self.assertTrue(success)
+        return outputs
+
+    def test_strips_do_not_leak_into_later_variants(self):
+        # Бюджет меньше кадра включает наложение полосами
+        strips = self.render_variants(800 * 600 * 8 - 1, 'strips')
+        full_frame = self.render_variants(1024 * 1024 * 1024, 'full_frame')
+        for strip_path, frame_path in zip(strips, full_frame):
+            with Image.open(strip_path) as a, Image.open(frame_path) as b:
+                self.assertIsNone(ImageChops.difference(a.convert('RGB'), b.convert('RGB')).getbbox(),
+                                  strip_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
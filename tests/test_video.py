@@ -0,0 +1,112 @@
+import os
+import shutil
+import subprocess
+import unittest
+
+from PIL import Image, ImageChops
+
+from helpers import WatermarkTestCase, script
+
+
+@unittest.skipUnless(shutil.which('ffmpeg') and shutil.which('ffprobe'), "нужны ffmpeg и ffprobe")
+class SegmentedVideoTest(WatermarkTestCase):
+    DURATION = 45
+    MIN_PSNR = 50.0
+
+    def setUp(self):
+        super().setUp()
+        self.input_path = os.path.join(self.temp.name, 'clip.mp4')
+        subprocess.run([
+            'ffmpeg', '-v', 'error',
+            '-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=30',
+            '-f', 'lavfi', '-i', 'sine=frequency=440',
+            '-t', str(self.DURATION), '-c:v', 'libx264', '-g', '60', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-shortest', self.input_path
+        ], check=True)
+
+    def packets(self, path):
+        output = subprocess.check_output([
+            'ffprobe', '-v', 'error', '-count_packets',
+            '-show_entries', 'stream=codec_type,nb_read_packets', '-of', 'csv=p=0', path
+        ]).decode()
+        return sorted(output.split())
+
+    def test_segments_match_single_encode(self):
+        config = {'opacity': 0.3, 'tile_enabled': True, 'density': 4}
+        segmented = os.path.join(self.temp.name, 'segmented.mp4')
+        single = os.path.join(self.temp.name, 'single.mp4')
+        self.assertEqual(len(script.VideoHandler.plan_segments(
+            self.DURATION, script.VideoHandler.keyframes(self.input_path), 3)), 3)
+        self.assertTrue(script.VideoHandler.apply_watermark(self.input_path, self.watermark_path,
+                                                            segmented, config, workers=3))
+        self.assertTrue(script.VideoHandler.apply_watermark(self.input_path, self.watermark_path,
+                                                            single, config, workers=1))
+
+        # Ни один кадр не потерян и не продублирован, звук на месте
+        self.assertEqual(self.packets(segmented), self.packets(self.input_path))
+
+        # Кадр за кадром сегментированный результат совпадает с цельным кодированием
+        stats = os.path.join(self.temp.name, 'psnr.log')
+        subprocess.run(['ffmpeg', '-v', 'error', '-i', segmented, '-i', single,
+                        '-lavfi', f'psnr=stats_file={stats}', '-f', 'null', '-'], check=True)
+        with open(stats) as f:
+            values = [line.split('psnr_avg:')[1].split()[0] for line in f]
+        self.assertEqual(len(values), self.DURATION * 30)
+        worst = min(float(value) for value in values)
+        self.assertGreater(worst, self.MIN_PSNR)
+
+
+class PlanSegmentsTest(unittest.TestCase):
+    def test_segments_not_shorter_than_minimum(self):
+        minimum = script.VideoHandler.MIN_SEGMENT_SECONDS
+        for duration in (20.0, 25.0, 45.0, 61.5, 300.0):
+            keyframes = [i * 0.5 for i in range(int(duration * 2))]
+            for count in (2, 3, 4, 8, 32):
+                segments = script.VideoHandler.plan_segments(duration, keyframes, count)
+                lengths = [length if length is not None else duration - start
+                           for start, length in segments]
+                self.assertTrue(all(length >= minimum for length in lengths), (duration, count, lengths))
+                self.assertAlmostEqual(sum(lengths), duration)
+
+    def test_sparse_keyframes_do_not_give_short_segments(self):
+        # Ближайшие к равному делению ключевые кадры дали бы сегменты 9 и 7 секунд
+        segments = script.VideoHandler.plan_segments(30.0, [0.0, 9.0, 16.0, 25.0], 3)
+        self.assertEqual(segments, [(0.0, 16.0), (16.0, None)])
+
+
+@unittest.skipUnless(shutil.which('ffmpeg') and shutil.which('ffprobe'), "нужны ffmpeg и ffprobe")
+class RotatedVideoTest(WatermarkTestCase):
+    def setUp(self):
+        super().setUp()
+        coded = os.path.join(self.temp.name, 'coded.mp4')
+        subprocess.run([
+            'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'color=c=gray:size=640x360:rate=25',
+            '-t', '1', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', coded
+        ], check=True)
+        # Вертикальный ролик с телефона: кадры 640x360 и матрица поворота на 90°
+        self.input_path = os.path.join(self.temp.name, 'portrait.mp4')
+        subprocess.run(['ffmpeg', '-v', 'error', '-display_rotation', '90', '-i', coded,
+                        '-c', 'copy', self.input_path], check=True)
+
+    def first_frame(self, path):
+        frame = os.path.join(self.temp.name, os.path.basename(path) + '.png')
+        subprocess.run(['ffmpeg', '-v', 'error', '-i', path, '-frames:v', '1', frame], check=True)
+        with Image.open(frame) as image:
+            return image.convert('RGB')
+
+    def test_watermark_covers_rotated_frame(self):
+        self.assertEqual(script.VideoHandler.probe(self.input_path)[:2], (360, 640))
+        output_path = os.path.join(self.temp.name, 'out.mp4')
+        config = {'opacity': 0.8, 'tile_enabled': True, 'density': 2}
+        self.assertTrue(script.VideoHandler.apply_watermark(self.input_path, self.watermark_path,
+                                                            output_path, config, workers=1))
+
+        source, result = self.first_frame(self.input_path), self.first_frame(output_path)
+        self.assertEqual(result.size, (360, 640))
+        # Нижние знаки сетки попадают в нижнюю часть вертикального кадра
+        bottom = (0, 480, 360, 640)
+        self.assertIsNotNone(ImageChops.difference(source.crop(bottom), result.crop(bottom)).getbbox())
+
+
+if __name__ == '__main__':
+    unittest.main()